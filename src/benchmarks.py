@@ -0,0 +1,125 @@
+"""Benchmarks check_health() against simulated replica sets (see mongod_simulator).
+
+    python benchmarks.py [--iterations 50] [--sizes 2,3,5,7] [--latency 0.001]
+    python benchmarks.py --proxy [--iterations 1000000]
+
+For every set size, fault scenario and kind of check this prints the p50 and p99
+latency of check_health() in milliseconds and the checks completed per second.
+Scenarios with a hung member are only run for checks that have a deadline.
+
+With --proxy it instead prints the cost of looking up a method of the wrapped
+connection directly, through plain __getattr__ forwarding and through PyMongoFrisk.
+"""
+import optparse, sys, time
+from pymongo_frisk import FriskConnection, PyMongoFrisk, health_status
+from mongod_simulator import SimulatedReplicaSet
+
+def slow_member(replica_set):
+    replica_set.nodes[-1].latency = 0.05
+
+def fsync_locked_member(replica_set):
+    replica_set.nodes[-1].fsync_locked = True
+
+def flaky_member(replica_set):
+    replica_set.nodes[-1].drop_rate = 0.5
+
+def hung_member(replica_set):
+    replica_set.nodes[-1].hang = True
+
+SCENARIOS = [('healthy', None),
+             ('slow member', slow_member),
+             ('fsync locked member', fsync_locked_member),
+             ('flaky member', flaky_member),
+             ('hung member', hung_member)]
+
+CHECKS = [('FriskConnection', lambda replica_set: FriskConnection(replica_set.hosts), {}, False),
+          ('FriskConnection concurrent', lambda replica_set: FriskConnection(replica_set.hosts),
+           {'concurrent': True, 'timeout': 0.5}, True),
+          ('PyMongoFrisk', lambda replica_set: PyMongoFrisk(replica_set.uri()), {}, False)]
+
+def percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+def measure(check, iterations):
+    """Returns (p50 ms, p99 ms, checks per second) of iterations calls to check()."""
+    latencies = []
+    started = time.time()
+    for i in range(iterations):
+        before = time.time()
+        check()
+        latencies.append(time.time() - before)
+    elapsed = time.time() - started
+    latencies.sort()
+    return percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000, iterations / elapsed
+
+def run(sizes, iterations, latency, out=sys.stdout):
+    out.write('%-28s %4s  %-20s %9s %9s %9s\n' % ('check', 'size', 'scenario', 'p50 ms', 'p99 ms', 'checks/s'))
+    for size in sizes:
+        for scenario, fault in SCENARIOS:
+            for name, connect, options, has_deadline in CHECKS:
+                if fault is hung_member and not has_deadline:
+                    continue
+                replica_set = SimulatedReplicaSet(size, latency=latency).start()
+                try:
+                    try:
+                        connection = connect(replica_set)
+                        if fault is not None:
+                            fault(replica_set)
+                        else:
+                            status = health_status(connection.check_health(**options))
+                            if status != 'ok':
+                                raise ValueError('the healthy set was reported %s' % status)
+                        p50, p99, rate = measure(lambda: connection.check_health(**options), iterations)
+                    except Exception as e:
+                        out.write('%-28s %4d  %-20s skipped: %s\n' % (name, size, scenario, e))
+                        continue
+                    out.write('%-28s %4d  %-20s %9.2f %9.2f %9.1f\n' % (name, size, scenario, p50, p99, rate))
+                finally:
+                    replica_set.stop()
+
+class ForwardingProxy(object):
+    """Forwards every lookup with __getattr__, as PyMongoFrisk did before it cached
+    the connection's bound methods.
+    """
+    def __init__(self, connection):
+        self._connection = connection
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+def lookups_per_second(target, iterations):
+    started = time.time()
+    for i in range(iterations):
+        target.database_names
+    return iterations / (time.time() - started)
+
+def run_proxy(iterations, out=sys.stdout):
+    replica_set = SimulatedReplicaSet(2).start()
+    try:
+        frisk = PyMongoFrisk(replica_set.uri())
+        connection = frisk._connection
+        out.write('%-28s %14s %9s\n' % ('lookup through', 'lookups/s', 'ns each'))
+        for name, target in [('pymongo Connection', connection),
+                             ('__getattr__ forwarding', ForwardingProxy(connection)),
+                             ('PyMongoFrisk', frisk)]:
+            rate = lookups_per_second(target, iterations)
+            out.write('%-28s %14.0f %9.1f\n' % (name, rate, 1e9 / rate))
+    finally:
+        replica_set.stop()
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--iterations', type='int', default=None,
+                      help='checks per scenario, or lookups with --proxy [default: 50, or 1000000]')
+    parser.add_option('--sizes', default='2,3,5,7', help='comma separated replica set sizes [default: %default]')
+    parser.add_option('--latency', type='float', default=0.001,
+                      help='seconds every simulated node waits before answering [default: %default]')
+    parser.add_option('--proxy', action='store_true', help='measure attribute lookups through PyMongoFrisk')
+    options, args = parser.parse_args(argv)
+    if options.proxy:
+        run_proxy(options.iterations or 1000000)
+    else:
+        run([int(size) for size in options.sizes.split(',')], options.iterations or 50, options.latency)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,419 @@
+"""In-process MongoDB replica set simulator for testing and benchmarking pymongo_frisk
+without a live cluster.
+
+Each SimulatedNode listens on a loopback port and speaks enough of the legacy wire
+protocol (OP_QUERY/OP_REPLY plus the fire-and-forget OP_INSERT, OP_UPDATE and
+OP_DELETE) to answer what pymongo and Frisk send: ismaster, ping, listDatabases,
+getnonce/authenticate, getlasterror, findandmodify, serverStatus, queries against
+system.namespaces and $cmd.sys.inprog, and plain queries and writes on a shared
+in-memory store. Nodes can be made slow, hung, fsync locked, flaky or stopped.
+
+    with SimulatedReplicaSet(3, latency=0.001) as replica_set:
+        replica_set.nodes[2].fsync_locked = True
+        connection = FriskConnection(replica_set.hosts)
+        connection.check_health()
+"""
+import random, socket, struct, threading, time
+import bson
+from bson.objectid import ObjectId
+from bson.son import SON
+
+OP_REPLY = 1
+OP_UPDATE = 2001
+OP_INSERT = 2002
+OP_QUERY = 2004
+OP_GET_MORE = 2005
+OP_DELETE = 2006
+OP_KILL_CURSORS = 2007
+
+QUERY_SLAVE_OK = 4
+REPLY_QUERY_FAILURE = 2
+UPDATE_UPSERT = 1
+UPDATE_MULTI = 2
+DELETE_SINGLE = 1
+
+def _read_cstring(data, position):
+    end = data.index(b'\x00', position)
+    name = data[position:end]
+    if not isinstance(name, str):
+        name = name.decode('utf-8')
+    return name, end + 1
+
+def _matches(document, spec):
+    for key, condition in spec.items():
+        present = key in document
+        value = document.get(key)
+        if isinstance(condition, dict) and condition and list(condition)[0].startswith('$'):
+            for operator, operand in condition.items():
+                if operator == '$exists' and present != bool(operand):
+                    return False
+                if operator == '$in' and value not in operand:
+                    return False
+                if operator == '$nin' and value in operand:
+                    return False
+                if operator == '$ne' and value == operand:
+                    return False
+                if operator in ('$lt', '$lte', '$gt', '$gte'):
+                    if not present:
+                        return False
+                    if operator == '$lt' and not value < operand:
+                        return False
+                    if operator == '$lte' and not value <= operand:
+                        return False
+                    if operator == '$gt' and not value > operand:
+                        return False
+                    if operator == '$gte' and not value >= operand:
+                        return False
+        elif not present or value != condition:
+            return False
+    return True
+
+def _apply_update(document, update):
+    if not [key for key in update if key.startswith('$')]:
+        replacement = dict(update)
+        replacement['_id'] = document['_id']
+        return replacement
+    document = dict(document)
+    for key, value in update.get('$set', {}).items():
+        document[key] = value
+    for key in update.get('$unset', {}):
+        document.pop(key, None)
+    for key, value in update.get('$inc', {}).items():
+        document[key] = document.get(key, 0) + value
+    return document
+
+class SimulatedReplicaSet(object):
+    """size nodes sharing one in-memory store; nodes[0] is the primary. Keyword
+    arguments are passed to every SimulatedNode.
+    """
+    def __init__(self, size=3, name='frisk', **node_options):
+        self.name = name
+        self._collections = {}
+        self._lock = threading.Lock()
+        self.nodes = [SimulatedNode(self, **node_options) for i in range(size)]
+        self.primary = self.nodes[0]
+
+    @property
+    def hosts(self):
+        return [node.host for node in self.nodes]
+
+    def uri(self, username='frisk', password='frisk', database='monitoring'):
+        return 'mongodb://%s:%s@%s/%s' % (username, password, ','.join(self.hosts), database)
+
+    def start(self):
+        for node in self.nodes:
+            node.start()
+        return self
+
+    def stop(self):
+        for node in self.nodes:
+            node.stop()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def elect(self, node):
+        """Makes node the primary."""
+        self.primary = node
+
+    def find(self, namespace, spec, limit=0):
+        self._lock.acquire()
+        try:
+            documents = [dict(document) for document in self._collections.get(namespace, {}).values()
+                         if _matches(document, spec)]
+        finally:
+            self._lock.release()
+        if limit:
+            documents = documents[:abs(limit)]
+        return documents
+
+    def insert(self, namespace, documents):
+        self._lock.acquire()
+        try:
+            collection = self._collections.setdefault(namespace, {})
+            for document in documents:
+                document = dict(document)
+                document.setdefault('_id', ObjectId())
+                collection[document['_id']] = document
+                if namespace.endswith('.system.indexes') and 'ns' in document:
+                    self._collections.setdefault(document['ns'], {})
+        finally:
+            self._lock.release()
+        return len(documents)
+
+    def update(self, namespace, spec, update, upsert=False, multi=False, new=True):
+        """Applies update and returns (documents updated, new or old first document)."""
+        self._lock.acquire()
+        try:
+            collection = self._collections.setdefault(namespace, {})
+            matched = [document for document in collection.values() if _matches(document, spec)]
+            if not multi:
+                matched = matched[:1]
+            if not matched and upsert:
+                document = dict((key, value) for key, value in spec.items() if not isinstance(value, dict))
+                document = _apply_update(dict(document, _id=document.get('_id', random.getrandbits(63))), update)
+                collection[document['_id']] = document
+                return 1, dict(document)
+            first = None
+            for document in matched:
+                updated = _apply_update(document, update)
+                collection[document['_id']] = updated
+                if first is None:
+                    first = new and updated or document
+            return len(matched), first and dict(first)
+        finally:
+            self._lock.release()
+
+    def remove(self, namespace, spec, single=False):
+        self._lock.acquire()
+        try:
+            collection = self._collections.get(namespace, {})
+            matched = [key for key, document in collection.items() if _matches(document, spec)]
+            if single:
+                matched = matched[:1]
+            for key in matched:
+                del collection[key]
+        finally:
+            self._lock.release()
+        return len(matched)
+
+    def namespaces(self):
+        self._lock.acquire()
+        try:
+            return list(self._collections)
+        finally:
+            self._lock.release()
+
+class SimulatedNode(object):
+    """One simulated mongod. latency seconds are slept before every reply. A hung node
+    accepts connections and requests but never answers. drop_rate is the chance of a
+    request being answered by closing the connection instead. fsync_locked nodes say
+    so through $cmd.sys.inprog, like a member locked with db.fsyncLock().
+    """
+    def __init__(self, replica_set, latency=0.0, hang=False, fsync_locked=False, drop_rate=0.0):
+        self.replica_set = replica_set
+        self.latency = latency
+        self.hang = hang
+        self.fsync_locked = fsync_locked
+        self.drop_rate = drop_rate
+        self.running = False
+        self.opcounters = {'insert': 0, 'query': 0, 'update': 0, 'delete': 0, 'getmore': 0, 'command': 0}
+        self._clients = set()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._listener.bind(('127.0.0.1', 0))
+        self.port = self._listener.getsockname()[1]
+        self.host = 'localhost:%d' % self.port
+        self._last_error = {'err': None, 'n': 0}
+
+    @property
+    def is_primary(self):
+        return self.replica_set.primary is self
+
+    @property
+    def connections(self):
+        return len(self._clients)
+
+    def start(self):
+        self._listener.listen(128)
+        self.running = True
+        thread = threading.Thread(target=self._accept_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        """Stops listening and drops every open connection, like a crashed member."""
+        self.running = False
+        self._stopped.set()
+        self._close(self._listener)
+        self._lock.acquire()
+        try:
+            clients = list(self._clients)
+            self._clients.clear()
+        finally:
+            self._lock.release()
+        for client in clients:
+            self._close(client)
+
+    def _close(self, sock):
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        sock.close()
+
+    def _accept_forever(self):
+        while self.running:
+            try:
+                client, address = self._listener.accept()
+            except socket.error:
+                return
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._lock.acquire()
+            try:
+                self._clients.add(client)
+            finally:
+                self._lock.release()
+            thread = threading.Thread(target=self._serve, args=(client,))
+            thread.daemon = True
+            thread.start()
+
+    def _receive(self, client, length):
+        data = b''
+        while len(data) < length:
+            chunk = client.recv(length - len(data))
+            if not chunk:
+                raise socket.error("connection closed")
+            data += chunk
+        return data
+
+    def _serve(self, client):
+        try:
+            while self.running:
+                header = self._receive(client, 16)
+                length, request_id, response_to, op_code = struct.unpack('<iiii', header)
+                body = self._receive(client, length - 16)
+                if self.hang:
+                    self._stopped.wait()
+                    return
+                if self.drop_rate and random.random() < self.drop_rate:
+                    return
+                if self.latency:
+                    time.sleep(self.latency)
+                reply = self._handle(op_code, body)
+                if reply is not None:
+                    flags, documents = reply
+                    client.sendall(self._reply(request_id, flags, documents))
+        except socket.error:
+            pass
+        finally:
+            self._lock.acquire()
+            try:
+                self._clients.discard(client)
+            finally:
+                self._lock.release()
+            self._close(client)
+
+    def _reply(self, request_id, flags, documents):
+        payload = b''.join([bson.BSON.encode(document) for document in documents])
+        header = struct.pack('<iiiiiqii', 36 + len(payload), random.getrandbits(31), request_id, OP_REPLY,
+                             flags, 0, 0, len(documents))
+        return header + payload
+
+    def _handle(self, op_code, body):
+        if op_code == OP_QUERY:
+            return self._query(body)
+        if op_code == OP_GET_MORE:
+            self.opcounters['getmore'] += 1
+            return 0, []
+        if op_code in (OP_INSERT, OP_UPDATE, OP_DELETE):
+            self._write(op_code, body)
+        return None
+
+    def _query(self, body):
+        flags = struct.unpack('<i', body[:4])[0]
+        namespace, position = _read_cstring(body, 4)
+        skip, limit = struct.unpack('<ii', body[position:position + 8])
+        query = bson.decode_all(body[position + 8:], SON)[0]
+        database, collection = namespace.split('.', 1)
+        if collection == '$cmd':
+            self.opcounters['command'] += 1
+            try:
+                return 0, [self._command(database, query)]
+            except Exception as e:
+                return 0, [{'ok': 0.0, 'errmsg': '%s: %s' % (type(e).__name__, e)}]
+        self.opcounters['query'] += 1
+        if collection == '$cmd.sys.inprog':
+            return 0, [self._inprog()]
+        if not self.is_primary and not flags & QUERY_SLAVE_OK:
+            return REPLY_QUERY_FAILURE, [{'$err': 'not master and slaveok=false', 'code': 13435}]
+        if collection == 'system.namespaces':
+            names = [name for name in self.replica_set.namespaces()
+                     if name.startswith(database + '.') and name != database + '.system.indexes']
+            if names:
+                names.append(database + '.system.indexes')
+            return 0, [{'name': name} for name in names]
+        if '$query' in query:
+            query = query['$query']
+        return 0, self.replica_set.find(namespace, query, limit)[skip:]
+
+    def _command(self, database, command):
+        name = list(command)[0]
+        handler = getattr(self, '_command_' + name.lower(), None)
+        if handler is None:
+            return {'ok': 0.0, 'errmsg': 'no such cmd: %s' % name}
+        return handler(database, command)
+
+    def _command_ismaster(self, database, command):
+        return {'ismaster': self.is_primary, 'secondary': not self.is_primary, 'setName': self.replica_set.name,
+                'hosts': self.replica_set.hosts, 'primary': self.replica_set.primary.host, 'me': self.host,
+                'maxBsonObjectSize': 16 * 1024 * 1024, 'ok': 1.0}
+
+    def _command_ping(self, database, command):
+        return {'ok': 1.0}
+
+    def _command_buildinfo(self, database, command):
+        return {'version': '2.0.1', 'versionArray': [2, 0, 1, 0], 'ok': 1.0}
+
+    def _command_getnonce(self, database, command):
+        return {'nonce': '%016x' % random.getrandbits(64), 'ok': 1.0}
+
+    def _command_authenticate(self, database, command):
+        return {'ok': 1.0}
+
+    def _command_getlasterror(self, database, command):
+        return dict(self._last_error, ok=1.0)
+
+    def _command_listdatabases(self, database, command):
+        names = set(['admin', 'local'])
+        names.update(name.split('.', 1)[0] for name in self.replica_set.namespaces())
+        return {'databases': [{'name': name, 'sizeOnDisk': 1.0, 'empty': False} for name in sorted(names)],
+                'totalSize': float(len(names)), 'ok': 1.0}
+
+    def _command_findandmodify(self, database, command):
+        if not self.is_primary:
+            return {'ok': 0.0, 'errmsg': 'not master'}
+        namespace = '%s.%s' % (database, command[list(command)[0]])
+        self.opcounters['update'] += 1
+        n, document = self.replica_set.update(namespace, command.get('query', {}), command.get('update', {}),
+                                              upsert=command.get('upsert', False), new=command.get('new', False))
+        return {'value': document, 'ok': 1.0}
+
+    def _command_serverstatus(self, database, command):
+        return {'host': self.host, 'version': '2.0.1', 'uptime': 1.0,
+                'globalLock': {'currentQueue': {'total': 0, 'readers': 0, 'writers': 0},
+                               'activeClients': {'total': 0, 'readers': 0, 'writers': 0}},
+                'connections': {'current': self.connections, 'available': 800},
+                'opcounters': dict(self.opcounters), 'ok': 1.0}
+
+    def _inprog(self):
+        status = {'inprog': []}
+        if self.fsync_locked:
+            status['fsyncLock'] = 1
+            status['info'] = 'use db.fsyncUnlock() to terminate the fsync write/snapshot lock'
+        return status
+
+    def _write(self, op_code, body):
+        namespace, position = _read_cstring(body, 4)
+        if not self.is_primary or self.fsync_locked:
+            self._last_error = {'err': 'not master', 'code': 10058, 'n': 0}
+            return
+        if op_code == OP_INSERT:
+            self.opcounters['insert'] += 1
+            n = self.replica_set.insert(namespace, bson.decode_all(body[position:]))
+        elif op_code == OP_UPDATE:
+            self.opcounters['update'] += 1
+            flags = struct.unpack('<i', body[position:position + 4])[0]
+            spec, update = bson.decode_all(body[position + 4:])
+            n = self.replica_set.update(namespace, spec, update, flags & UPDATE_UPSERT, flags & UPDATE_MULTI)[0]
+        else:
+            self.opcounters['delete'] += 1
+            flags = struct.unpack('<i', body[position:position + 4])[0]
+            spec = bson.decode_all(body[position + 4:])[0]
+            n = self.replica_set.remove(namespace, spec, flags & DELETE_SINGLE)
+        self._last_error = {'err': None, 'n': n}
@@ -1,185 +1,2604 @@
-import datetime, copy, uuid
+import datetime, copy, uuid, time, threading, socket, json, bisect, random, os, mmap, struct, types, collections, weakref
+from array import array
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+try:
+    import SocketServer as socketserver
+except ImportError:
+    import socketserver
+try:
+    _string_types = basestring
+except NameError:
+    _string_types = str
 import pymongo
 from pymongo.connection import Connection as mongo_con
 from pymongo import Connection
 
-class FriskConnection(pymongo.Connection):
+WRITE_LOCKED = "Write Locked"
+TIMED_OUT = "Timed Out"
+SKIPPED = "Skipped"
+
+PING, READ, FULL = 'ping', 'read', 'full'
+CHECK_LEVELS = (PING, READ, FULL)
+
+SAVE_PROBE, FIND_AND_MODIFY_PROBE = 'save', 'find_and_modify'
+WRITE_PROBES = (SAVE_PROBE, FIND_AND_MODIFY_PROBE)
+
+OK, DEGRADED, DOWN, STARTING, CONNECTING, STALE = 'ok', 'degraded', 'down', 'starting', 'connecting', 'stale'
+
+PRIMARY, SECONDARY = 'primary', 'secondary'
+
+_clock = getattr(time, 'perf_counter', time.time)
+
+def _run_probes(probes, timeout=None, max_workers=8):
+    """Runs (key, probe) pairs on at most max_workers daemon threads and returns a dict
+    of key -> result. Probes still outstanding after timeout seconds are reported as
+    TIMED_OUT; the ones already running are left to finish in the background and the
+    ones not yet started are dropped.
+    """
+    return dict(_iter_probes(probes, timeout, max_workers))
+
+def _iter_probes(probes, timeout=None, max_workers=8, skipped=TIMED_OUT):
+    """Like _run_probes, but yields (key, result) pairs as the probes finish, followed
+    by (key, TIMED_OUT) for each one still running at the deadline and (key, skipped)
+    for each one never started.
+    """
+    probes = list(probes)
+    pending = queue.Queue()
+    for probe in probes:
+        pending.put(probe)
+    finished = queue.Queue()
+    expired = threading.Event()
+
+    def worker():
+        while not expired.isSet():
+            try:
+                key, probe = pending.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                result = probe()
+            except Exception:
+                result = False
+            finished.put((key, result))
+
+    for i in range(min(max_workers, len(probes))):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+
+    deadline = None
+    if timeout is not None:
+        deadline = time.time() + timeout
+    outstanding = set(key for key, probe in probes)
+    try:
+        while outstanding:
+            try:
+                if deadline is None:
+                    key, result = finished.get()
+                else:
+                    key, result = finished.get(True, max(0, deadline - time.time()))
+            except queue.Empty:
+                break
+            outstanding.discard(key)
+            yield key, result
+    finally:
+        expired.set()
+    unstarted = set()
+    while True:
+        try:
+            unstarted.add(pending.get_nowait()[0])
+        except queue.Empty:
+            break
+    for key, probe in probes:
+        if key in unstarted:
+            yield key, skipped
+        elif key in outstanding:
+            yield key, TIMED_OUT
+
+def _host_key(host, default_port=27017):
+    if ':' in host:
+        return host
+    return '%s:%d' % (host, default_port)
+
+def _member_key(host, port):
+    return '%s:%d' % (str(host).lower(), port)
+
+class ProbeConnectionPool(object):
+    """Thread safe cache of long lived probe connections keyed by 'host:port', or by
+    the slave's URI for PyMongoFrisk, whose connections are authenticated.
+    Connections are opened lazily on first use, dropped when a probe through them
+    fails so that the next check reconnects, and evicted once no owner lists their
+    member any more. One pool may be shared by several Frisk connections; owners are
+    held weakly, and forgotten once released or garbage collected.
+    """
+    def __init__(self):
+        self._connections = {}
+        self._members = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._connections)
+
+    def get(self, key, connect):
+        """Returns (connection, reused) for key, calling connect() only when there is no
+        open connection to reuse.
+        """
+        self._lock.acquire()
+        try:
+            connection = self._connections.get(key)
+        finally:
+            self._lock.release()
+        if connection is not None:
+            return connection, True
+        connection = connect()
+        self._lock.acquire()
+        try:
+            pooled = self._connections.setdefault(key, connection)
+        finally:
+            self._lock.release()
+        if pooled is not connection:
+            connection.disconnect()
+        return pooled, False
+
+    def discard(self, key):
+        self._lock.acquire()
+        try:
+            connection = self._connections.pop(key, None)
+        finally:
+            self._lock.release()
+        if connection is not None:
+            self._disconnect(connection)
+
+    def retain(self, owner, keys):
+        """Records keys as the current members of owner and evicts the connections of
+        members that no owner lists any more.
+        """
+        self._lock.acquire()
+        try:
+            self._members[id(owner)] = (weakref.ref(owner), set(keys))
+            evicted = self._evict_unwanted()
+        finally:
+            self._lock.release()
+        for connection in evicted:
+            self._disconnect(connection)
+
+    def release(self, owner):
+        """Forgets the members of owner, evicting the connections of those no other
+        owner lists.
+        """
+        self._lock.acquire()
+        try:
+            entry = self._members.get(id(owner))
+            if entry is not None and entry[0]() is owner:
+                del self._members[id(owner)]
+            evicted = self._evict_unwanted()
+        finally:
+            self._lock.release()
+        for connection in evicted:
+            self._disconnect(connection)
+
+    def _evict_unwanted(self):
+        wanted = set()
+        for key, (owner, members) in list(self._members.items()):
+            if owner() is None:
+                del self._members[key]
+            else:
+                wanted.update(members)
+        return [self._connections.pop(key) for key in list(self._connections) if key not in wanted]
+
+    def close(self):
+        self._lock.acquire()
+        try:
+            evicted = list(self._connections.values())
+            self._connections.clear()
+            self._members.clear()
+        finally:
+            self._lock.release()
+        for connection in evicted:
+            self._disconnect(connection)
+
+    def _disconnect(self, connection):
+        try:
+            connection.disconnect()
+        except:
+            pass
+
+class HealthCache(object):
+    """Keeps the latest result of probe() for ttl seconds. get() answers from the snapshot,
+    with its age in seconds added as 'db_health_age'; callers that find it cold or expired
+    share a single in-flight probe. start() keeps it warm from a daemon thread that
+    re-probes every refresh_interval seconds.
+    """
+    def __init__(self, probe, ttl=5, refresh_interval=None):
+        self._probe = probe
+        self.ttl = ttl
+        self.refresh_interval = refresh_interval
+        self._snapshot = None
+        self._error = None
+        self._in_flight = None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def get(self):
+        snapshot = self._snapshot
+        if snapshot is None or time.time() - snapshot[1] > self.ttl:
+            snapshot = self.refresh()
+        health, taken = snapshot
+        health = dict(health)
+        health['db_health_age'] = max(0.0, time.time() - taken)
+        return health
+
+    def peek(self):
+        """Returns the latest (health, taken) snapshot, however old, or None before the
+        first probe has finished. Never probes.
+        """
+        return self._snapshot
+
+    def refresh(self):
+        """Probes now, or waits for the probe another thread already has in flight, and
+        returns the new (health, taken) snapshot.
+        """
+        self._lock.acquire()
+        try:
+            in_flight = self._in_flight
+            leader = in_flight is None
+            if leader:
+                in_flight = self._in_flight = threading.Event()
+        finally:
+            self._lock.release()
+        if not leader:
+            in_flight.wait()
+            if self._error is not None:
+                raise self._error
+            return self._snapshot
+        try:
+            try:
+                health = self._probe()
+            except Exception as e:
+                self._error = e
+                raise
+            self._error = None
+            self._snapshot = (health, time.time())
+            return self._snapshot
+        finally:
+            self._lock.acquire()
+            try:
+                self._in_flight = None
+            finally:
+                self._lock.release()
+            in_flight.set()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._refresh_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _refresh_forever(self):
+        while not self._stopped.isSet():
+            try:
+                self.refresh()
+            except Exception:
+                pass
+            self._stopped.wait(self.refresh_interval)
+
+def _load_health(payload):
+    health = json.loads(payload)
+    for key, value in health.items():
+        if isinstance(value, list) and value and all(isinstance(item, list) for item in value):
+            health[key] = [tuple(item) for item in value]
+    return health
+
+class SharedHealthCache(object):
+    """Health cache shared by the processes of a prefork server through a memory
+    mapped file at path. One process at a time, elected by holding an flock on
+    path + '.lock', probes every refresh_interval seconds and publishes the result;
+    every other process only reads it. Readers take no lock: the header holds a
+    sequence number that is odd while a snapshot is being written, and a read is
+    retried if the number was odd or changed while copying.
+
+    Health is stored as JSON; its lists of pairs are turned back into lists of tuples
+    when read. Enable the cache after the server forks, as the background thread and
+    the lock are per process.
+    """
+    _header = struct.Struct('<QdII')
+
+    def __init__(self, path, probe, ttl=5, refresh_interval=1, size=65536):
+        if fcntl is None:
+            raise RuntimeError("SharedHealthCache needs fcntl.flock")
+        self.path = path
+        self._probe = probe
+        self.ttl = ttl
+        self.refresh_interval = refresh_interval
+        self.size = size
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if os.fstat(fd).st_size < size:
+                os.ftruncate(fd, size)
+            self._map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self._lock_fd = os.open(path + '.lock', os.O_RDWR | os.O_CREAT, 0o600)
+        self._leading = False
+        self._refreshing = threading.Lock()
+        self._seen = (None, None)
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def get(self):
+        snapshot = self.peek()
+        if snapshot is None or time.time() - snapshot[1] > self.ttl:
+            snapshot = self.refresh()
+        health, taken = snapshot
+        health = dict(health)
+        health['db_health_age'] = max(0.0, time.time() - taken)
+        return health
+
+    def peek(self):
+        """Returns the latest published (health, taken) snapshot, or None. Never probes
+        and never blocks on the writer; an unchanged snapshot is returned as the same
+        object.
+        """
+        header = self._header
+        for attempt in range(1000):
+            sequence = header.unpack_from(self._map, 0)[0]
+            if sequence == 0:
+                return None
+            if sequence % 2:
+                continue
+            if sequence == self._seen[0]:
+                return self._seen[1]
+            sequence, taken, length, pid = header.unpack_from(self._map, 0)
+            payload = self._map[header.size:header.size + length]
+            if header.unpack_from(self._map, 0)[0] == sequence and length <= self.size - header.size:
+                snapshot = (_load_health(payload.decode('utf-8')), taken)
+                self._seen = (sequence, snapshot)
+                return snapshot
+        return self._seen[1]
+
+    def refresh(self):
+        """Probes and publishes a new snapshot when this process is, or can become, the
+        writer. Otherwise waits up to ttl seconds for the writer to publish one. Returns
+        the latest snapshot.
+        """
+        previous = self._header.unpack_from(self._map, 0)[0]
+        if not self._refreshing.acquire(False):
+            self._refreshing.acquire()
+            self._refreshing.release()
+            return self._latest()
+        try:
+            if self._lead():
+                try:
+                    self._publish(self._probe(), time.time())
+                finally:
+                    if self._thread is None:
+                        self._resign()
+                return self._latest()
+        finally:
+            self._refreshing.release()
+        deadline = time.time() + self.ttl
+        while self._header.unpack_from(self._map, 0)[0] == previous and time.time() < deadline:
+            time.sleep(0.01)
+        return self._latest()
+
+    def is_writer(self):
+        return self._leading
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._refresh_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._resign()
+
+    def _refresh_forever(self):
+        while not self._stopped.isSet():
+            if self._lead():
+                try:
+                    self.refresh()
+                except Exception:
+                    pass
+            self._stopped.wait(self.refresh_interval)
+
+    def _latest(self):
+        snapshot = self.peek()
+        if snapshot is None:
+            return ({'db_error': "No health snapshot published"}, time.time())
+        return snapshot
+
+    def _lead(self):
+        if not self._leading:
+            try:
+                fcntl.flock(self._lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                self._leading = True
+            except (IOError, OSError):
+                pass
+        return self._leading
+
+    def _resign(self):
+        if self._leading:
+            self._leading = False
+            fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+    def _publish(self, health, taken):
+        header = self._header
+        payload = json.dumps(health, default=str).encode('utf-8')
+        if len(payload) > self.size - header.size:
+            payload = json.dumps({'db_error': "Health too large for the shared cache"}).encode('utf-8')
+        sequence = header.unpack_from(self._map, 0)[0]
+        if sequence % 2:
+            sequence += 1
+        header.pack_into(self._map, 0, sequence + 1, taken, len(payload), os.getpid())
+        self._map[header.size:header.size + len(payload)] = payload
+        header.pack_into(self._map, 0, sequence + 2, taken, len(payload), os.getpid())
+
+class _PhaseTimer(object):
+    def __init__(self, timings, phase):
+        self._timings = timings
+        self._phase = phase
+
+    def __enter__(self):
+        self._started = _clock()
+
+    def __exit__(self, *exc_info):
+        self._timings[self._phase] = round((_clock() - self._started) * 1000, 3)
+
+class _NoTimer(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+_no_timer = _NoTimer()
+
+class CheckSchedule(object):
+    """Chooses the level of checks made without an explicit one: FULL on the first
+    check and every full_every checks after it, and the cheaper level otherwise.
+    """
+    def __init__(self, full_every=10, otherwise=PING):
+        if otherwise not in CHECK_LEVELS:
+            raise ValueError("Unknown check level %r" % (otherwise,))
+        self.full_every = full_every
+        self.otherwise = otherwise
+        self._checks = 0
+        self._lock = threading.Lock()
+
+    def next_level(self):
+        self._lock.acquire()
+        try:
+            checks = self._checks
+            self._checks += 1
+        finally:
+            self._lock.release()
+        if checks % self.full_every == 0:
+            return FULL
+        return self.otherwise
+
+class _Circuit(object):
+    def __init__(self):
+        self.state = 'closed'
+        self.failures = 0
+        self.opened = 0
+        self.retry_at = 0
+        self.last_failure = False
+
+class CircuitBreaker(object):
+    """Per node circuit breaker for slave probes. After failure_threshold failed probes
+    in a row a node's circuit opens: its probes are skipped and it is reported with
+    its last failure straight away. Once the backoff delay has passed a single
+    half-open trial probe is let through, which closes the circuit if it succeeds
+    and reopens it otherwise. The delay starts at base_delay, doubles on each
+    reopening up to max_delay, and is shortened at random by up to jitter of itself
+    so that many clients do not retry a recovering node in step.
+    """
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+    def __init__(self, failure_threshold=3, base_delay=1, max_delay=60, jitter=0.5):
+        self.failure_threshold = failure_threshold
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self._circuits = {}
+        self._lock = threading.Lock()
+
+    def allow(self, node):
+        """Returns whether node may be probed now. Once an open circuit's delay has
+        passed only the first caller is allowed, as the half-open trial.
+        """
+        self._lock.acquire()
+        try:
+            circuit = self._circuits.get(node)
+            if circuit is None or circuit.state == self.CLOSED:
+                return True
+            if circuit.state == self.OPEN and time.time() >= circuit.retry_at:
+                circuit.state = self.HALF_OPEN
+                return True
+            return False
+        finally:
+            self._lock.release()
+
+    def record(self, node, result):
+        """Records the check_health() result of a probe of node. Anything but True or
+        "Write Locked" is a failure.
+        """
+        self._lock.acquire()
+        try:
+            circuit = self._circuits.setdefault(node, _Circuit())
+            if result is True or result == WRITE_LOCKED:
+                circuit.state = self.CLOSED
+                circuit.failures = circuit.opened = 0
+                return
+            circuit.failures += 1
+            circuit.last_failure = result
+            if circuit.state == self.HALF_OPEN or circuit.failures >= self.failure_threshold:
+                delay = min(self.max_delay, self.base_delay * 2 ** circuit.opened)
+                circuit.opened += 1
+                circuit.state = self.OPEN
+                circuit.retry_at = time.time() + delay * (1 - self.jitter * random.random())
+        finally:
+            self._lock.release()
+
+    def state(self, node):
+        circuit = self._circuits.get(node)
+        if circuit is None:
+            return self.CLOSED
+        return circuit.state
+
+    def last_failure(self, node):
+        circuit = self._circuits.get(node)
+        if circuit is None:
+            return False
+        return circuit.last_failure
+
+    def open_nodes(self):
+        """Returns the nodes whose circuit is open or half-open, sorted."""
+        self._lock.acquire()
+        try:
+            return sorted(node for node, circuit in self._circuits.items() if circuit.state != self.CLOSED)
+        finally:
+            self._lock.release()
+
+class ReadRouter(object):
+    """Routes slave_okay reads by the health checks' slave probes. It keeps an
+    exponentially weighted moving average (weight alpha) of each slave's probe
+    latency, and best() is the fastest slave whose last probe could read from it. A
+    slave that fails its probe, times out or is write locked leaves the rotation until
+    a probe reads from it again; its routed connection is kept, as the application
+    may still be using it. A slave that leaves the replica set is forgotten and its
+    routed connection closed.
+    """
+    def __init__(self, alpha=0.3):
+        self.alpha = alpha
+        self._latencies = {}
+        self._readable = {}
+        self._connections = {}
+        self._lock = threading.Lock()
+
+    def observe(self, node, probe, result, seconds):
+        """Records a finished probe, in the same way as ProbeMetrics.observe."""
+        if probe != 'slave_read':
+            return
+        if result is not True:
+            self._drop(node)
+            return
+        self._lock.acquire()
+        try:
+            latency = self._latencies.get(node)
+            if latency is None:
+                latency = seconds
+            else:
+                latency += self.alpha * (seconds - latency)
+            self._latencies[node] = latency
+            self._readable[node] = True
+        finally:
+            self._lock.release()
+
+    def timed_out(self, node, probe):
+        if probe == 'slave_read':
+            self._drop(node)
+
+    def ranking(self):
+        """Returns [(slave, average probe latency in milliseconds)] of the slaves in
+        rotation, fastest first.
+        """
+        self._lock.acquire()
+        try:
+            ranked = sorted((latency, node) for node, latency in self._latencies.items() if self._readable.get(node))
+        finally:
+            self._lock.release()
+        return [(node, round(latency * 1000, 3)) for latency, node in ranked]
+
+    def best(self):
+        ranking = self.ranking()
+        if not ranking:
+            return None
+        return ranking[0][0]
+
+    def connection(self, node, connect):
+        """Returns the routed connection to node, calling connect() to open it once."""
+        self._lock.acquire()
+        try:
+            connection = self._connections.get(node)
+        finally:
+            self._lock.release()
+        if connection is not None:
+            return connection
+        connection = connect()
+        self._lock.acquire()
+        try:
+            routed = self._connections.setdefault(node, connection)
+        finally:
+            self._lock.release()
+        if routed is not connection:
+            connection.disconnect()
+        return routed
+
+    def retain(self, nodes):
+        """Forgets the slaves not in nodes, the current slaves of the replica set, and
+        closes their routed connections.
+        """
+        nodes = set(nodes)
+        self._lock.acquire()
+        try:
+            for node in [node for node in self._latencies if node not in nodes]:
+                del self._latencies[node]
+            for node in [node for node in self._readable if node not in nodes]:
+                del self._readable[node]
+            departed = [self._connections.pop(node) for node in list(self._connections) if node not in nodes]
+        finally:
+            self._lock.release()
+        for connection in departed:
+            try:
+                connection.disconnect()
+            except:
+                pass
+
+    def close(self):
+        self._lock.acquire()
+        try:
+            connections = list(self._connections.values())
+            self._connections.clear()
+        finally:
+            self._lock.release()
+        for connection in connections:
+            connection.disconnect()
+
+    def _drop(self, node):
+        self._lock.acquire()
+        try:
+            self._readable[node] = False
+        finally:
+            self._lock.release()
+
+class TopologyTracker(object):
+    """Index of the members seen by the health checks of one replica set, keyed by
+    'host:port' and holding each member's role ('primary' or 'secondary'). update()
+    returns the members added, removed and changed role since the previous check and
+    passes any such change to the on_change() callbacks.
+
+    A slave only gets the full depth of its check while it is new, has changed role or
+    failed its last probe; one that is known to be healthy is just pinged, and fully
+    probed again after every full_every pings. full_every=None pings it for good.
+    """
+    def __init__(self, full_every=10):
+        self.full_every = full_every
+        self.members = {}
+        self._healthy = {}
+        self._pings = {}
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def on_change(self, callback):
+        """Calls callback(change) whenever update() finds the membership changed."""
+        self._callbacks.append(callback)
+
+    def update(self, members):
+        """Replaces the index with members, a dict of member -> role, and returns the
+        change as {'added': [...], 'removed': [...], 'changed': [...]}.
+        """
+        self._lock.acquire()
+        try:
+            previous = self.members
+            change = {'added': sorted(member for member in members if member not in previous),
+                      'removed': sorted(member for member in previous if member not in members),
+                      'changed': sorted(member for member, role in members.items()
+                                        if member in previous and previous[member] != role)}
+            for member in change['added'] + change['removed'] + change['changed']:
+                self._healthy.pop(member, None)
+                self._pings.pop(member, None)
+            self.members = dict(members)
+        finally:
+            self._lock.release()
+        if change['added'] or change['removed'] or change['changed']:
+            for callback in list(self._callbacks):
+                try:
+                    callback(change)
+                except:
+                    pass
+        return change
+
+    def needs_full_probe(self, member):
+        if not self._healthy.get(member):
+            return True
+        return self.full_every is not None and self._pings.get(member, 0) >= self.full_every
+
+    def record(self, member, result, level):
+        """Records the result of a probe of member made at level."""
+        self._lock.acquire()
+        try:
+            if member not in self.members:
+                return
+            self._healthy[member] = result is True
+            if level == PING:
+                self._pings[member] = self._pings.get(member, 0) + 1
+            else:
+                self._pings[member] = 0
+        finally:
+            self._lock.release()
+
+class _Ring(object):
+    """Fixed size ring buffer of (time, latency, readable) samples held in arrays."""
+    def __init__(self, size):
+        self.times = array('d', [0.0]) * size
+        self.latencies = array('d', [0.0]) * size
+        self.readable = array('b', [0]) * size
+        self.next = 0
+        self.count = 0
+
+    def append(self, taken, latency, readable):
+        index = self.next
+        self.times[index] = taken
+        self.latencies[index] = latency
+        self.readable[index] = readable
+        self.next = (index + 1) % len(self.times)
+        self.count = min(self.count + 1, len(self.times))
+
+    def since(self, start):
+        """Returns [(latency, readable)] of the samples taken at or after start."""
+        samples = []
+        index = self.next
+        for i in range(self.count):
+            index = (index - 1) % len(self.times)
+            if self.times[index] < start:
+                break
+            samples.append((self.latencies[index], self.readable[index]))
+        return samples
+
+def _percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+class HealthHistory(object):
+    """Keeps the last size probe results of every node and probe ('master_write',
+    'master_read' or 'slave_read') in fixed size array ring buffers, so memory stays
+    constant however long the process runs. Set it as a connection's history and it
+    records every probe that finishes.
+    """
+    def __init__(self, size=1024):
+        self.size = size
+        self._rings = {}
+        self._lock = threading.Lock()
+
+    def observe(self, node, probe, result, seconds):
+        """Records a finished probe, in the same way as ProbeMetrics.observe."""
+        readable = result is True or result == WRITE_LOCKED
+        self._lock.acquire()
+        try:
+            ring = self._rings.get((node, probe))
+            if ring is None:
+                ring = self._rings[(node, probe)] = _Ring(self.size)
+            ring.append(time.time(), seconds, readable)
+        finally:
+            self._lock.release()
+
+    def timed_out(self, node, probe):
+        """Probes reported as "Timed Out" are recorded once they finish."""
+
+    def series(self):
+        """Returns the (node, probe) pairs with recorded samples, sorted."""
+        self._lock.acquire()
+        try:
+            return sorted(self._rings)
+        finally:
+            self._lock.release()
+
+    def samples(self, node, probe, window=None):
+        """Returns [(latency in seconds, succeeded)] of the probes of node recorded in
+        the last window seconds (all of those kept without a window), newest first.
+        """
+        start = 0
+        if window is not None:
+            start = time.time() - window
+        self._lock.acquire()
+        try:
+            ring = self._rings.get((node, probe))
+            if ring is None:
+                return []
+            return [(latency, bool(readable)) for latency, readable in ring.since(start)]
+        finally:
+            self._lock.release()
+
+    def availability(self, node, probe, window=None):
+        """Returns the fraction of the probes in the window that succeeded, or None."""
+        samples = self.samples(node, probe, window)
+        if not samples:
+            return None
+        return sum(1 for latency, succeeded in samples if succeeded) / float(len(samples))
+
+    def latency(self, node, probe, window=None, percentiles=(0.5, 0.9, 0.99)):
+        """Returns {'count', 'min', 'max', 'mean'} and a 'p<n>' entry per percentile of
+        the latencies of the probes in the window that succeeded, in milliseconds, with
+        the number of failed and timed out probes, which are left out, as 'failed'.
+        The latencies are None when no probe succeeded, and it returns None without
+        samples.
+        """
+        samples = self.samples(node, probe, window)
+        if not samples:
+            return None
+        latencies = sorted(latency * 1000 for latency, succeeded in samples if succeeded)
+        stats = {'count': len(latencies),
+                 'failed': len(samples) - len(latencies),
+                 'min': None,
+                 'max': None,
+                 'mean': None}
+        for fraction in percentiles:
+            stats['p%g' % (fraction * 100)] = None
+        if latencies:
+            stats.update({'min': latencies[0],
+                          'max': latencies[-1],
+                          'mean': sum(latencies) / len(latencies)})
+            for fraction in percentiles:
+                stats['p%g' % (fraction * 100)] = _percentile(latencies, fraction)
+        return stats
+
+_SAMPLED_OPERATIONS = ('find', 'find_one', 'insert', 'save', 'update', 'remove')
+
+class OperationSampler(object):
+    """Times a random sample_rate of the find, find_one, insert, save, update and
+    remove calls made through the databases of a PyMongoFrisk whose
+    operation_sampler it is. It keeps the count, mean and maximum latency of each
+    operation per collection, and a log of the last slow_log_size sampled operations
+    that took slow_ms milliseconds or more. find is timed until its first document.
+    """
+    def __init__(self, sample_rate=0.01, slow_ms=100, slow_log_size=100):
+        self.sample_rate = sample_rate
+        self.slow_ms = slow_ms
+        self._stats = {}
+        self._slow = collections.deque(maxlen=slow_log_size)
+        self._lock = threading.Lock()
+
+    def sampled(self):
+        return random.random() < self.sample_rate
+
+    def record(self, namespace, operation, seconds):
+        milliseconds = seconds * 1000
+        self._lock.acquire()
+        try:
+            stats = self._stats.get((namespace, operation))
+            if stats is None:
+                stats = self._stats[(namespace, operation)] = [0, 0.0, 0.0]
+            stats[0] += 1
+            stats[1] += milliseconds
+            stats[2] = max(stats[2], milliseconds)
+            if milliseconds >= self.slow_ms:
+                self._slow.append((time.time(), namespace, operation, round(milliseconds, 3)))
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        """Returns {collection: {operation: {'count', 'mean_ms', 'max_ms'}}} of the
+        sampled operations.
+        """
+        self._lock.acquire()
+        try:
+            recorded = [(key, list(stats)) for key, stats in self._stats.items()]
+        finally:
+            self._lock.release()
+        stats = {}
+        for (namespace, operation), (count, total, longest) in recorded:
+            stats.setdefault(namespace, {})[operation] = {'count': count,
+                                                          'mean_ms': round(total / count, 3),
+                                                          'max_ms': round(longest, 3)}
+        return stats
+
+    def slow_operations(self):
+        """Returns [(time, collection, operation, milliseconds)], oldest first."""
+        self._lock.acquire()
+        try:
+            return list(self._slow)
+        finally:
+            self._lock.release()
+
+class _SampledDatabase(object):
+    def __init__(self, database, sampler):
+        self._database = database
+        self._sampler = sampler
+
+    def __getattr__(self, name):
+        return self._wrap(getattr(self._database, name))
+
+    def __getitem__(self, name):
+        return self._wrap(self._database[name])
+
+    def _wrap(self, value):
+        if isinstance(value, pymongo.collection.Collection):
+            return _SampledCollection(value, self._sampler)
+        return value
+
+class _SampledCollection(_SampledDatabase):
+    def __getattr__(self, name):
+        value = getattr(self._database, name)
+        if name in _SAMPLED_OPERATIONS:
+            return self._sample(name, value)
+        return self._wrap(value)
+
+    def _sample(self, operation, method):
+        sampler = self._sampler
+        namespace = self._database.full_name
+        def sampled(*args, **kwargs):
+            if not sampler.sampled():
+                return method(*args, **kwargs)
+            started = _clock()
+            if operation == 'find':
+                return _TimedCursor(method(*args, **kwargs),
+                                    lambda: sampler.record(namespace, operation, _clock() - started))
+            try:
+                return method(*args, **kwargs)
+            finally:
+                sampler.record(namespace, operation, _clock() - started)
+        return sampled
+
+class _TimedCursor(object):
+    """Cursor calling record() once its first document, or its end, has arrived."""
+    def __init__(self, cursor, record):
+        self._cursor = cursor
+        self._record = record
+
+    def __getattr__(self, name):
+        value = getattr(self._cursor, name)
+        if not callable(value):
+            return value
+        def chained(*args, **kwargs):
+            result = value(*args, **kwargs)
+            if result is self._cursor:
+                return self
+            return result
+        return chained
+
+    def __getitem__(self, index):
+        return self._cursor[index]
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        record, self._record = self._record, None
+        if record is None:
+            return next(self._cursor)
+        try:
+            return next(self._cursor)
+        finally:
+            record()
+
+    __next__ = next
+
+class _Check(object):
+    """State shared by the probes of a single check_health() call."""
+    def __init__(self, timings=False, level=FULL, max_lag=None):
+        self.level = level
+        self.max_lag = max_lag
+        self.reused = []
+        self.timings = None
+        if timings:
+            self.timings = {}
+        self.written = None
+        self.write_done = threading.Event()
+        self._cleanups = []
+        self._finished = False
+        self.meters = []
+        self.member_levels = {}
+        self.load = {}
+        self._settled = set()
+        self._lock = threading.Lock()
+
+    def level_for(self, member):
+        return self.member_levels.get(member, self.level)
+
+    def wrote(self, database, query):
+        """Records the document the master write probe left behind, when replication lag
+        is being measured, so that the slaves can be polled for it.
+        """
+        if self.max_lag is not None:
+            self.written = (time.time(), database, query)
+
+    def defer(self, cleanup):
+        """Queues cleanup to run at finish(), or runs it now if the check has finished."""
+        self._lock.acquire()
+        try:
+            if not self._finished:
+                self._cleanups.append(cleanup)
+                return
+        finally:
+            self._lock.release()
+        self._run(cleanup)
+
+    def settle(self, key):
+        """Returns True the first time the probe of key is settled, either as finished
+        or as reported "Timed Out", and False afterwards.
+        """
+        self._lock.acquire()
+        try:
+            if key in self._settled:
+                return False
+            self._settled.add(key)
+            return True
+        finally:
+            self._lock.release()
+
+    def finish(self):
+        self._lock.acquire()
+        try:
+            self._finished = True
+            cleanups, self._cleanups = self._cleanups, []
+        finally:
+            self._lock.release()
+        while cleanups:
+            self._run(cleanups.pop())
+
+    def _run(self, cleanup):
+        try:
+            cleanup()
+        except:
+            pass
+
+    def timed(self, node, phase):
+        """Context manager recording how long its block took, in milliseconds, as
+        timings[node][phase] when timings were asked for.
+        """
+        if self.timings is None:
+            return _no_timer
+        return _PhaseTimer(self.timings.setdefault(node, {}), phase)
+
+    def annotate(self, health):
+        health['db_check_level'] = self.level
+        if self.load:
+            health['db_load'] = self.load
+        if self.timings is not None:
+            health['db_timings'] = self.timings
+        return health
+
+def _health_state(health, previous=None):
+    """Flattens a check_health() result into {(node, check): value}, with check one of
+    'role', 'can_read' and 'can_write', and (None, 'error') or (None, 'state') for the
+    cluster. A master write the check's level did not verify keeps its previous value.
+    """
+    state = {}
+    if 'db_error' in health:
+        state[(None, 'error')] = health['db_error']
+    if 'db_state' in health:
+        state[(None, 'state')] = health['db_state']
+    master = health.get('db_master_host')
+    if master is not None:
+        state[(master, 'role')] = PRIMARY
+        state[(master, 'can_read')] = health.get('db_master_can_read')
+        can_write = health.get('db_master_can_write')
+        if can_write is None and previous is not None:
+            can_write = previous.get((master, 'can_write'))
+        if can_write is not None:
+            state[(master, 'can_write')] = can_write
+    for slave, can_read in health.get('db_slaves_can_read', []):
+        state[(slave, 'role')] = SECONDARY
+        state[(slave, 'can_read')] = can_read
+    return state
+
+def _state_changes(previous, state, when):
+    """Returns a change event for every (node, check) whose value differs."""
+    events = []
+    for key in sorted(set(previous) | set(state), key=lambda key: (str(key[0]), key[1])):
+        if previous.get(key) != state.get(key):
+            events.append({'time': when, 'node': key[0], 'check': key[1],
+                           'previous': previous.get(key), 'new': state.get(key)})
+    return events
+
+class _HealthCheckMixin(object):
+    """Opt-in behaviour shared by FriskConnection and PyMongoFrisk. Each class provides
+    _check_health(**options), which always probes.
+    """
+    health_cache = None
+    check_schedule = None
+    write_probe = SAVE_PROBE
+    probe_document_id = None
+    max_probe_workers = 8
+    lag_poll_interval = 0.005
+    metrics = None
+    circuit_breaker = None
+    read_router = None
+    topology = None
+    history = None
+    slave_network_timeout = 2
+    max_queued = None
+    probe_ttl = None
+    slave_priorities = None
+    _opcounters = None
+    _cache_options = None
+    probe_slots = None
+
+    def enable_health_cache(self, ttl=5, refresh_interval=None, **options):
+        """Makes check_health() answer from a HealthCache holding the result of
+        _check_health(**options) for ttl seconds. With refresh_interval the cache is
+        refreshed in the background and callers never wait on a probe once it is warm.
+        Only calls asking for the same options are answered from the cache; the others
+        probe as if it were not there.
+        """
+        self.disable_health_cache()
+        self._cache_options = dict(self._health_defaults, **options)
+        self.health_cache = HealthCache(lambda: self._check_health(**options), ttl, refresh_interval)
+        if refresh_interval:
+            self.health_cache.start()
+        return self.health_cache
+
+    def enable_shared_health_cache(self, path, ttl=5, refresh_interval=1, **options):
+        """Like enable_health_cache(), but with a SharedHealthCache at path so that the
+        processes of a prefork server share one stream of probes.
+        """
+        self.disable_health_cache()
+        self._cache_options = dict(self._health_defaults, **options)
+        self.health_cache = SharedHealthCache(path, lambda: self._check_health(**options), ttl, refresh_interval)
+        self.health_cache.start()
+        return self.health_cache
+
+    def disable_health_cache(self):
+        if self.health_cache is not None:
+            self.health_cache.stop()
+            self.health_cache = None
+            self._cache_options = None
+
+    def submit_check_health(self, executor, **options):
+        """Submits check_health(**options) to executor, a concurrent.futures style
+        executor, and returns its future. As for check_health(), the health cache only
+        answers when options are the ones it was enabled with.
+        """
+        return executor.submit(lambda: self.check_health(**options))
+
+    def _cached_or_checked(self, **options):
+        """Answers check_health(**options) from the health cache when it probes with
+        the same options, and by probing otherwise.
+        """
+        if self.health_cache is not None and options == self._cache_options:
+            return self.health_cache.get()
+        return self._check_health(**options)
+
+    def _run_health_probes(self, probes, concurrent=False, timeout=None, started=None, budget=None):
+        """Runs the probes returned by _health_probes(), the master ones first, and
+        returns the assembled check_health dictionary. With concurrent the slave probes
+        run on up to max_probe_workers threads. With a timeout every probe still running
+        timeout seconds after started is reported as TIMED_OUT: concurrently the master
+        probes run on threads of their own alongside the slaves, otherwise all the
+        probes run one after the other on a single thread. A budget is handled by
+        _run_budgeted_probes().
+        """
+        if started is None:
+            started = time.time()
+        master_probes, slave_probes, assemble = probes
+        if self.probe_slots is not None:
+            master_probes, slave_probes = self._slotted(master_probes), self._slotted(slave_probes)
+        if budget is not None:
+            return self._run_budgeted_probes(master_probes, slave_probes, assemble, budget, started)
+        if timeout is not None:
+            remaining = max(0, timeout - (time.time() - started))
+            workers = 1
+            if concurrent:
+                workers = self.max_probe_workers + len(master_probes)
+            return assemble(_run_probes(master_probes + slave_probes, remaining, workers))
+        results = dict((key, probe()) for key, probe in master_probes)
+        if concurrent and len(slave_probes) > 1:
+            results.update(_run_probes(slave_probes, None, self.max_probe_workers))
+        else:
+            results.update((key, probe()) for key, probe in slave_probes)
+        return assemble(results)
+
+    def _run_budgeted_probes(self, master_probes, slave_probes, assemble, budget, started):
+        """Queues the master probes, then the slave probes in priority order and the
+        replication lag poll last, so that it never keeps a slave from its probe, for up
+        to max_probe_workers threads. At budget seconds after started the probes not yet
+        begun are dropped and reported as SKIPPED, and the running ones are abandoned
+        and reported as TIMED_OUT. 'db_budget' lists the 'completed', 'timed_out' and
+        'skipped' probes.
+        """
+        lag = [item for item in master_probes if item[0] == 'db_slaves_replication_lag_ms']
+        master_probes = [item for item in master_probes if item not in lag]
+        probes = master_probes + self._by_priority(slave_probes) + lag
+        remaining = max(0, budget - (time.time() - started))
+        results = dict(_iter_probes(probes, remaining, self.max_probe_workers, SKIPPED))
+        health = assemble(results)
+        outcomes = {'completed': [], 'timed_out': [], 'skipped': []}
+        for key, probe in probes:
+            if results[key] == SKIPPED:
+                outcomes['skipped'].append(key)
+            elif results[key] == TIMED_OUT:
+                outcomes['timed_out'].append(key)
+            else:
+                outcomes['completed'].append(key)
+        health['db_budget'] = outcomes
+        return health
+
+    def _slotted(self, probes):
+        """Makes each node probe hold one of probe_slots, a semaphore shared with other
+        connections, while it runs. The replication lag poll, which mostly waits on
+        the master write, is left as it is.
+        """
+        slots = self.probe_slots
+        def slotted(probe):
+            def run():
+                slots.acquire()
+                try:
+                    return probe()
+                finally:
+                    slots.release()
+            return run
+        return [(key, probe if key == 'db_slaves_replication_lag_ms' else slotted(probe)) for key, probe in probes]
+
+    def _by_priority(self, slave_probes):
+        """Orders slave probes by slave_priorities, highest first, then by the read
+        router's ranking, keeping their order otherwise.
+        """
+        priorities = self.slave_priorities or {}
+        ranks = {}
+        if self.read_router is not None:
+            for rank, (node, latency) in enumerate(self.read_router.ranking()):
+                ranks[node] = rank
+        return sorted(slave_probes, key=lambda item: (-priorities.get(item[0], 0), ranks.get(item[0], len(ranks))))
+
+    def watch(self, interval=1, initial=False, **options):
+        """Generator calling check_health(**options) every interval seconds and yielding
+        only what changed, as {'time', 'node', 'check', 'previous', 'new'} events. check
+        is 'role' ('primary', 'secondary', or None for a member that joined or left),
+        'can_read' or 'can_write' of node, or 'error' or 'state' with node None. The
+        first check only sets the baseline unless initial is True.
+        """
+        state = None
+        while True:
+            started = time.time()
+            current = _health_state(self.check_health(**options), state)
+            if state is not None or initial:
+                for event in _state_changes(state or {}, current, started):
+                    yield event
+            state = current
+            time.sleep(max(0, interval - (time.time() - started)))
+
+    def _check_level(self, level=None):
+        if level is None:
+            if self.check_schedule is None:
+                return FULL
+            return self.check_schedule.next_level()
+        if level not in CHECK_LEVELS:
+            raise ValueError("Unknown check level %r" % (level,))
+        return level
+
+    def _write_probe(self):
+        if self.write_probe not in WRITE_PROBES:
+            raise ValueError("Unknown write probe %r" % (self.write_probe,))
+        return self.write_probe
+
+    def _can_find_and_modify(self, collection, node, token, check):
+        """Proves a write and its read back in a single round trip: upserts token into
+        this client's probe document and compares it with the document the server
+        returns. The document is overwritten on every check, never removed.
+        """
+        if self.probe_document_id is None:
+            self.probe_document_id = 'frisk-' + socket.gethostname()
+        can_write = False
+        try:
+            with check.timed(node, 'find_and_modify'):
+                document = collection.find_and_modify({'_id': self.probe_document_id},
+                                                      {'$set': {'token': token}},
+                                                      upsert=True, new=True)
+            can_write = document is not None and document.get('token') == token
+        except:
+            pass
+        return can_write
+
+    def read_connection(self):
+        """Returns a slave_okay connection to the slave read_router ranks fastest, or
+        the master connection when no slave is in rotation or there is no read_router.
+        """
+        router = self.read_router
+        node = None
+        if router is not None:
+            node = router.best()
+        if node is None:
+            return self._master_connection()
+        return router.connection(node, lambda: self._connect_to_member(node))
+
+    def _track_topology(self, check, master, slaves):
+        """Updates topology with the members this check sees and pings the slaves it
+        already knows to be healthy instead of fully probing them.
+        """
+        members = dict((slave, SECONDARY) for slave in slaves)
+        members[master] = PRIMARY
+        change = self.topology.update(members)
+        if check.level != PING:
+            for slave in slaves:
+                if not self.topology.needs_full_probe(slave):
+                    check.member_levels[slave] = PING
+        return change
+
+    def _record_topology(self, check, results):
+        for slave, result in results:
+            self.topology.record(slave, result, check.level_for(slave))
+
+    def _observers(self):
+        return [observer for observer in (self.metrics, self.read_router, self.history) if observer is not None]
+
+    def _metered(self, check, key, node, probe_type, probe):
+        """Wraps probe so that its outcome and latency are recorded in metrics,
+        read_router and history, when set.
+        """
+        observers = self._observers()
+        if not observers:
+            return probe
+        check.meters.append((key, node, probe_type))
+        def metered():
+            started = _clock()
+            result = False
+            try:
+                result = probe()
+                return result
+            finally:
+                seconds = _clock() - started
+                counted = not check.settle(key)
+                for observer in observers:
+                    if not (counted and observer is self.metrics):
+                        observer.observe(node, probe_type, result, seconds)
+        return metered
+
+    def enable_probe_ttl(self, ttl=600, sweep=True):
+        """Lets the server expire the documents the save write probe leaves in
+        friskmonitoring, instead of removing each one at the end of its check: ensures a
+        TTL index on their 'created' date expiring them after ttl seconds and sets
+        probe_ttl. Expiry needs MongoDB 2.2 or later. With sweep=True the documents
+        earlier checks left behind, which have no 'created' date, are removed by
+        sweep_probe_documents() on a background thread, which is returned.
+        """
+        self._probe_collection().ensure_index('created', expireAfterSeconds=ttl)
+        self.probe_ttl = ttl
+        if not sweep:
+            return None
+        def run():
+            try:
+                self.sweep_probe_documents(ttl)
+            except Exception:
+                pass
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def sweep_probe_documents(self, older_than=600, batch_size=500):
+        """Removes the write probe documents left in friskmonitoring that are older than
+        older_than seconds, going by the time in their uuid1 _id, batch_size at a time.
+        Returns how many were removed.
+        """
+        collection = self._probe_collection()
+        cutoff = time.time() - older_than
+        removed = 0
+        batch = []
+        for document in collection.find({'created': {'$exists': False}}, ['_id']):
+            created = _uuid1_time(document['_id'])
+            if created is not None and created < cutoff:
+                batch.append(document['_id'])
+            if len(batch) >= batch_size:
+                collection.remove({'_id': {'$in': batch}})
+                removed += len(batch)
+                batch = []
+        if batch:
+            collection.remove({'_id': {'$in': batch}})
+            removed += len(batch)
+        return removed
+
+    def _diagnose(self, node, connection, check):
+        """Runs the diagnostics probe on node: a $cmd.sys.inprog query matching no
+        operation, which still carries the fsyncLock flag without listing every current
+        operation, then serverStatus for the load signals kept in check.load. Returns
+        WRITE_LOCKED when node is fsync locked, else True.
+        """
+        admin = connection.admin
+        with check.timed(node, 'inprog'):
+            locked = u"fsyncLock" in admin["$cmd.sys.inprog"].find_one({'opid': -1})
+        with check.timed(node, 'server_status'):
+            status = admin.command('serverStatus')
+        check.load[node] = self._load_signals(node, status)
+        if locked:
+            return WRITE_LOCKED
+        return True
+
+    def _load_signals(self, node, status):
+        """Returns the queued readers and writers, current connections and opcounter
+        deltas since the previous serverStatus of node (None the first time and after a
+        restart) from a serverStatus reply, and whether node is 'overloaded' when
+        max_queued is set.
+        """
+        queue = status.get('globalLock', {}).get('currentQueue', {})
+        counters = status.get('opcounters', {})
+        uptime = status.get('uptime', 0)
+        if self._opcounters is None:
+            self._opcounters = {}
+        previous = self._opcounters.get(node)
+        self._opcounters[node] = (uptime, counters)
+        deltas = None
+        if previous is not None and previous[0] <= uptime:
+            deltas = dict((name, count - previous[1].get(name, 0)) for name, count in counters.items())
+        signals = {'queued_readers': queue.get('readers'),
+                   'queued_writers': queue.get('writers'),
+                   'connections': status.get('connections', {}).get('current'),
+                   'opcounters': deltas}
+        if self.max_queued is not None:
+            signals['overloaded'] = (queue.get('readers') or 0) + (queue.get('writers') or 0) >= self.max_queued
+        return signals
+
+    def _guarded(self, node, probe):
+        """Wraps a slave probe so that it is skipped, and the node's last failure
+        returned, while circuit_breaker holds the node's circuit open.
+        """
+        breaker = self.circuit_breaker
+        if breaker is None:
+            return probe
+        def guarded():
+            if not breaker.allow(node):
+                return breaker.last_failure(node)
+            result = False
+            try:
+                result = probe()
+                return result
+            finally:
+                breaker.record(node, result)
+        return guarded
+
+    def _count_timeouts(self, check, results):
+        for key, node, probe_type in check.meters:
+            if results.get(key) == TIMED_OUT:
+                counted = not check.settle(key)
+                for observer in self._observers():
+                    if not (counted and observer is self.metrics):
+                        observer.timed_out(node, probe_type)
+
+    def _write_probe_task(self, write, check):
+        def probe():
+            try:
+                return write()
+            finally:
+                check.write_done.set()
+        return probe
+
+    def _replication_lag_probe(self, slaves, check):
+        """Returns a probe that waits for the master write probe and then measures how
+        long its document takes to reach each slave.
+        """
+        def probe():
+            try:
+                check.write_done.wait(check.max_lag)
+                return self._replication_lag(slaves, check)
+            finally:
+                check.finish()
+        return probe
+
+    def _replication_lag(self, slaves, check):
+        """Polls every slave concurrently for the document the master write probe left
+        and returns [(slave, milliseconds from the write until it was seen)], with None
+        for the slaves that did not have it within max_lag seconds of the write.
+        """
+        if check.written is None:
+            return [(slave, None) for slave in slaves]
+        written_at, database, query = check.written
+        deadline = written_at + check.max_lag
+        breaker = self.circuit_breaker
+        polls = [(slave, self._lag_poll(slave, database, query, written_at, deadline)) for slave in slaves
+                 if breaker is None or breaker.state(slave) == breaker.CLOSED]
+        lags = _run_probes(polls, max(0, deadline - time.time()), self.max_probe_workers)
+        return [(slave, _lag_or_none(lags.get(slave))) for slave in slaves]
+
+    def _lag_poll(self, slave, database, query, written_at, deadline):
+        def poll():
+            slave_connection, lag, failed = None, None, False
+            try:
+                slave_connection = self._open_slave(slave)
+                collection = slave_connection[database]['friskmonitoring']
+                while lag is None and time.time() < deadline:
+                    if collection.find_one(query) is not None:
+                        lag = round(max(0, time.time() - written_at) * 1000, 3)
+                    else:
+                        time.sleep(self.lag_poll_interval)
+            except:
+                failed = True
+            finally:
+                if slave_connection is not None:
+                    self._release_slave(slave, slave_connection, failed)
+            return lag
+        return poll
+
+def _bson_now():
+    """Returns datetime.utcnow() cut to the milliseconds a BSON date keeps, so that a
+    saved probe document reads back equal.
+    """
+    now = datetime.datetime.utcnow()
+    return now.replace(microsecond=now.microsecond // 1000 * 1000)
+
+def _unauthorized(error):
+    """Returns whether an OperationFailure is the server refusing the user (code 13)."""
+    message = str(error).lower()
+    return getattr(error, 'code', None) == 13 or 'unauthorized' in message or 'not authorized' in message
+
+def _read_back(found, written):
+    """Returns whether found is the probe document written. Only '_id' and 'date' are
+    compared: a tz_aware connection reads 'created' back as an aware datetime, which
+    Python 2 refuses to compare with the naive one written.
+    """
+    return found is not None and found.get('_id') == written['_id'] and found.get('date') == written['date']
+
+def _uuid1_time(value):
+    """Returns the time encoded in a uuid1 string, or None for anything else."""
+    try:
+        value = uuid.UUID(value)
+    except (TypeError, ValueError, AttributeError):
+        return None
+    if value.version != 1:
+        return None
+    return (value.time - 0x01b21dd213814000) / 1e7
+
+def _lag_or_none(lag):
+    if isinstance(lag, bool) or not isinstance(lag, (int, float)):
+        return None
+    return lag
+
+class FriskConnection(_HealthCheckMixin, pymongo.Connection):
     """Extension to the PyMongo Connection class that adds a check_health method for verifying
     connectivity to the Master as well as ALL Slaves in the Replica Set
     """
-    def check_health(self):
+    probe_pool = None
+    _health_defaults = {'concurrent': False, 'timeout': None, 'timings': False, 'level': None, 'max_lag': None, 'budget': None}
+
+    def check_health(self, concurrent=False, timeout=None, timings=False, level=None, max_lag=None, budget=None):
         """Returns the health of ALL nodes in a Replica Set in dictionary format.
         {'db_master_host': 'host1:27017', 'db_slave_hosts': ['host2:27018','host3:27019'], 
         'db_master_can_write': True, 'db_master_can_read': True,
         'db_slaves_can_read': [('host2',True),('host3',True)] }
+        The options, which should be passed by keyword, and the keys they add are
+        described in the README.
         """
-        db = 'monitoring'
-        db_master_can_write = self._can_write_to_master(db)
-        db_master_can_read = self._can_read_from_master(db)
+        return self._cached_or_checked(concurrent=concurrent, timeout=timeout, timings=timings, level=level,
+                                       max_lag=max_lag, budget=budget)
 
+    def _check_health(self, concurrent=False, timeout=None, timings=False, level=None, max_lag=None, budget=None):
+        started = time.time()
+        return self._run_health_probes(self._health_probes(timings, level, max_lag), concurrent, timeout, started, budget)
+
+    def _health_probes(self, timings=False, level=None, max_lag=None):
+        """Returns the master probes and the slave probes of one check as lists of
+        (key, probe) pairs, and a function building the check_health dictionary from a
+        dict of their results.
+        """
+        db = 'monitoring'
+        check = _Check(timings, self._check_level(level), max_lag)
+        master = self.host + ':' + str(self.port)
         slaves = self._get_slave_hosts()
-        db_slaves_can_read = self._can_read_from_slaves(slaves)
+        if self.probe_pool is not None:
+            self.probe_pool.retain(self, slaves)
+        if self.topology is not None:
+            change = self._track_topology(check, master, slaves)
+        master_probes = []
+        if check.level == FULL:
+            self._write_probe()
+            write = self._write_probe_task(lambda: self._can_write_to_master(db, check), check)
+            master_probes.append(('db_master_can_write', self._metered(check, 'db_master_can_write', master, 'master_write', write)))
+            if max_lag is not None:
+                master_probes.append(('db_slaves_replication_lag_ms', self._replication_lag_probe(slaves, check)))
+        if check.level == PING:
+            read = lambda: self._can_ping_master(check)
+        else:
+            read = lambda: self._can_read_from_master(db, check)
+        master_probes.append(('db_master_can_read', self._metered(check, 'db_master_can_read', master, 'master_read', read)))
+        slave_probes = [(slave, self._guarded(slave, self._metered(check, slave, slave, 'slave_read', self._slave_probe(slave, check))))
+                        for slave in slaves]
 
-        return {'db_master_host': self.host + ':' + str(self.port),
-                'db_slave_hosts': slaves,
-                'db_master_can_read':db_master_can_read,
-                'db_master_can_write':db_master_can_write,
-                'db_slaves_can_read':db_slaves_can_read
-                }
+        def assemble(results):
+            health = {'db_master_host': master,
+                      'db_slave_hosts': slaves,
+                      'db_master_can_read':results.get('db_master_can_read'),
+                      'db_master_can_write':results.get('db_master_can_write'),
+                      'db_slaves_can_read':[(slave, results[slave]) for slave in slaves]
+                      }
+            if max_lag is not None:
+                lags = results.get('db_slaves_replication_lag_ms')
+                if lags == SKIPPED:
+                    check.finish()
+                if not isinstance(lags, list):
+                    lags = [(slave, None) for slave in slaves]
+                health['db_slaves_replication_lag_ms'] = lags
+            if self.probe_pool is not None:
+                health['db_probe_connects_saved'] = len(check.reused)
+            if check.meters:
+                self._count_timeouts(check, results)
+            if self.circuit_breaker is not None:
+                health['db_open_circuits'] = self.circuit_breaker.open_nodes()
+            if self.read_router is not None:
+                self.read_router.retain(slaves)
+                health['db_read_ranking'] = self.read_router.ranking()
+            if self.topology is not None:
+                self._record_topology(check, health['db_slaves_can_read'])
+                health['db_topology_changes'] = change
+            return check.annotate(health)
+        return master_probes, slave_probes, assemble
 
     def _get_slave_hosts(self):
-        master_host = self.host
-        master_port = self.port
-        slaves = []
-        for node in self.nodes:
-            slave_host = node[0]
-            slave_port = node[1]
-            if '.' in slave_host:
-                slave_host = str(slave_host).split(".",1)[0]
-            if (slave_host != master_host or slave_port != master_port and not slave_host+':'+str(slave_port) in slaves):
-                slaves.append(slave_host+':'+str(slave_port))
-        return slaves
+        """Returns the 'host:port' of every member but the master, lower cased, once each
+        and sorted.
+        """
+        slaves = set(_member_key(host, port) for host, port in self.nodes)
+        slaves.discard(_member_key(self.host, self.port))
+        return sorted(slaves)
     
-    def _can_read_from_slaves(self, slaves):
-        db_slaves_can_read = []
-        for slave in slaves:
-            is_healthy = False
-            slave_connection = None
-            try:
-                slave_connection = pymongo.connection.Connection(slave, network_timeout=2, slave_okay=True)
-                stats=slave_connection.admin["$cmd.sys.inprog"].find_one()
-                if(u"fsyncLock" not in stats.keys()):
-                    if 'admin' in slave_connection.database_names():
-                        is_healthy = True
-                else:
-                    is_healthy="Write Locked"
-            except Exception as e:
-                pass
-            finally:
-                if slave_connection:
-                    slave_connection.disconnect()
-            db_slaves_can_read.append((slave, is_healthy))
-        return db_slaves_can_read
+    def _slave_probe(self, slave, check):
+        def probe():
+            with check.timed(slave, 'total'):
+                return self._can_read_from_slave(slave, check)
+        return probe
+
+    def _connect_to_slave(self, slave):
+        return pymongo.connection.Connection(slave, network_timeout=self.slave_network_timeout, slave_okay=True)
+
+    def _connect_to_member(self, slave):
+        """Opens a routed read connection to slave with the options and cached
+        credentials this connection was opened with, rather than the probe's.
+        """
+        # pymongo 2.0.1 keeps these private; read them from __dict__, as Connection's
+        # __getattr__ would answer a missing one with a Database.
+        state = self.__dict__
+        connection = pymongo.connection.Connection(slave, slave_okay=True,
+                                                   max_pool_size=state.get('_Connection__max_pool_size', 10),
+                                                   network_timeout=state.get('_Connection__network_timeout'),
+                                                   document_class=state.get('_Connection__document_class', dict),
+                                                   tz_aware=state.get('_Connection__tz_aware', False))
+        for database, (username, password) in state.get('_Connection__auth_credentials', {}).items():
+            connection._cache_credentials(database, username, password)
+        return connection
+
+    def _master_connection(self):
+        return self
+
+    def _open_slave(self, slave, check=None):
+        """Returns a connection to slave, taken from probe_pool when one is set."""
+        check = check or _Check()
+        with check.timed(slave, 'connect'):
+            if self.probe_pool is None:
+                return self._connect_to_slave(slave)
+            slave_connection, was_reused = self.probe_pool.get(slave, lambda: self._connect_to_slave(slave))
+        if was_reused:
+            check.reused.append(slave)
+        return slave_connection
 
-    def _can_write_to_master(self, db):
+    def _release_slave(self, slave, slave_connection, failed=False):
+        if self.probe_pool is None:
+            slave_connection.disconnect()
+        elif failed:
+            self.probe_pool.discard(slave)
+
+    def _can_read_from_slave(self, slave, check=None):
+        check = check or _Check()
+        is_healthy = False
+        slave_connection = None
+        failed = False
+        try:
+            slave_connection = self._open_slave(slave, check)
+            if check.level_for(slave) == PING:
+                with check.timed(slave, 'ping'):
+                    is_healthy = bool(slave_connection.admin.command('ping').get('ok'))
+            else:
+                is_healthy = self._diagnose(slave, slave_connection, check)
+        except Exception as e:
+            failed = True
+        finally:
+            if slave_connection is not None:
+                self._release_slave(slave, slave_connection, failed)
+        return is_healthy
+
+    def _can_write_to_master(self, db, check=None):
+        check = check or _Check()
+        master = self.host + ':' + str(self.port)
         master_db = self.db
+        if self._write_probe() == FIND_AND_MODIFY_PROBE:
+            token = self._get_new_uuid()
+            can_write = self._can_find_and_modify(master_db['friskmonitoring'], master, token, check)
+            if can_write:
+                check.wrote(master_db.name, {'_id': self.probe_document_id, 'token': token})
+            return can_write
         db_master_can_write = False
         try:
             id = self._get_new_uuid()
             test_data = {"_id":id, 'date': self._get_datetime_now_microseconds()}
-            master_db['friskmonitoring'].save(test_data)
-            db_master_can_write = master_db['friskmonitoring'].find_one({'_id':id}) == test_data
+            if self.probe_ttl is not None:
+                test_data['created'] = _bson_now()
+            with check.timed(master, 'save'):
+                master_db['friskmonitoring'].save(test_data)
+            with check.timed(master, 'find_one'):
+                db_master_can_write = _read_back(master_db['friskmonitoring'].find_one({'_id':id}), test_data)
+            if db_master_can_write:
+                check.wrote(master_db.name, {'_id':id})
         except:
             pass
         finally:
-            master_db['friskmonitoring'].remove({'_id':id})
+            if self.probe_ttl is None and check.written is None:
+                with check.timed(master, 'remove'):
+                    master_db['friskmonitoring'].remove({'_id':id})
+            elif self.probe_ttl is None:
+                check.defer(lambda: master_db['friskmonitoring'].remove({'_id':id}))
         return db_master_can_write
 
-    def _can_read_from_master(self, db):
+    def _can_read_from_master(self, db, check=None):
+        check = check or _Check()
+        master = self.host + ':' + str(self.port)
         master_db = self.db
         db_master_can_read = False
         try:
-            db_master_can_read = master_db.collection_names() != []
+            with check.timed(master, 'collection_names'):
+                db_master_can_read = master_db.collection_names() != []
         except:
             pass
         return db_master_can_read
 
+    def _can_ping_master(self, check=None):
+        check = check or _Check()
+        master = self.host + ':' + str(self.port)
+        db_master_can_read = False
+        try:
+            with check.timed(master, 'ping'):
+                db_master_can_read = bool(self.admin.command('ping').get('ok'))
+        except:
+            pass
+        return db_master_can_read
+
+    def _probe_collection(self):
+        return self.db['friskmonitoring']
+
     def _get_datetime_now_microseconds(self):
         return datetime.datetime.now().microsecond
         
     def _get_new_uuid(self):
         return str(uuid.uuid1())
 
-class PyMongoFrisk(object):
+class PyMongoFrisk(_HealthCheckMixin):
     """Wrapper for pymongo Connection allowing additional check_health method for checking connectivity 
-    of master and slave in a Replica Pair running in Auth mode
+    of the master and every slave of a Replica Pair or Replica Set running in Auth mode
+
+    With lazy=True the pymongo connection is only made on first use, and with
+    warm=True it is made by a background thread straight away; either way the
+    constructor does not wait on the network.
     """
-    def __init__(self, uri, **kw):
+    probe_pool = None
+    operation_sampler = None
+    _mongo_connection = None
+    _warming = None
+    _connect_error = None
+    _diagnostics_denied = False
+    _health_defaults = {'concurrent': True, 'timeout': None, 'timings': False, 'level': None, 'max_lag': None, 'budget': None}
+
+    def __init__(self, uri, lazy=False, warm=False, **kw):
         self._uri = copy.copy(uri)
         self._parse_uri(uri)
-        self._connection = mongo_con.from_uri(uri, **kw)
+        self._connection_options = kw
+        self._connect_lock = threading.Lock()
+        if warm:
+            self._warming = threading.Thread(target=self._warm)
+            self._warming.daemon = True
+            self._warming.start()
+        elif not lazy:
+            self._connect()
+
+    @property
+    def _connection(self):
+        connection = self._mongo_connection
+        if connection is None:
+            connection = self._connect()
+        return connection
+
+    def _connect(self):
+        self._connect_lock.acquire()
+        try:
+            if self._mongo_connection is None:
+                try:
+                    self._mongo_connection = mongo_con.from_uri(self._uri, **self._connection_options)
+                except Exception as e:
+                    self._connect_error = e
+                    raise
+                self._connect_error = None
+            return self._mongo_connection
+        finally:
+            self._connect_lock.release()
+
+    def _warm(self):
+        try:
+            self._connect()
+        except Exception:
+            # Recorded in _connect_error; the next check retries and reports it.
+            pass
+
+    def is_connecting(self):
+        """Returns whether the background connect of warm=True is still in progress."""
+        return self._mongo_connection is None and self._warming is not None and self._warming.is_alive()
+
+    def disconnect(self):
+        if self.probe_pool is not None:
+            self.probe_pool.release(self)
+        if self._mongo_connection is not None:
+            self._mongo_connection.disconnect()
 
     @classmethod
     def from_uri(cls, uri, **kw):
         return cls(uri, **kw)
 
     def __getattr__(self, attr_name):
-        return getattr(self._connection, attr_name)
+        value = getattr(self._connection, attr_name)
+        if isinstance(value, types.MethodType):
+            # Methods of the connection never change, so later lookups skip __getattr__.
+            setattr(self, attr_name, value)
+        elif self.operation_sampler is not None and isinstance(value, pymongo.database.Database):
+            return _SampledDatabase(value, self.operation_sampler)
+        return value
 
     def __getitem__(self,name):
-        return self._connection[name]
+        if self.operation_sampler is None:
+            return self._connection[name]
+        return _SampledDatabase(self._connection[name], self.operation_sampler)
+
+    def check_health(self, concurrent=True, timeout=None, timings=False, level=None, max_lag=None, budget=None):
+        """Returns the health of every host in the URI in dictionary format, with the same
+        keys and options as FriskConnection.check_health plus the Replica Pair keys. Only
+        concurrent defaults differently, to True.
+        {'db_master_host': 'host1', 'db_slave_hosts': ['host2','host3'],
+        'db_master_can_write': True, 'db_master_can_read': True,
+        'db_slaves_can_read': [('host2',True),('host3',True)],
+        'db_master_url': 'host1', 'db_slave_url': 'host2', 'db_slave_can_read': True}
+        """
+        return self._cached_or_checked(concurrent=concurrent, timeout=timeout, timings=timings, level=level,
+                                       max_lag=max_lag, budget=budget)
+
+    def _check_health(self, concurrent=True, timeout=None, timings=False, level=None, max_lag=None, budget=None):
+        if self.is_connecting():
+            return {'db_state': CONNECTING,
+                    'db_master_host': None, 'db_slave_hosts': [],
+                    'db_master_can_read': None, 'db_master_can_write': None, 'db_slaves_can_read': [],
+                    'db_master_url': None, 'db_slave_url': None, 'db_slave_can_read': None}
+        try:
+            self._connection
+        except Exception as e:
+            return {'db_error': str(e),
+                    'db_master_host': None, 'db_slave_hosts': [],
+                    'db_master_can_read': False, 'db_master_can_write': False, 'db_slaves_can_read': [],
+                    'db_master_url': None, 'db_slave_url': None, 'db_slave_can_read': False}
+        started = time.time()
+        return self._run_health_probes(self._health_probes(timings, level, max_lag), concurrent, timeout, started, budget)
 
-    def check_health(self):
-        """Returns the health of a both nodes in a Replica Pair connection in dictionary format.
-        {'db_master_url': 'host2', 'db_slave_url': 'host1', 
-        'db_master_can_write': True, 'db_master_can_read': True, 
-        'db_slave_can_read': True}
+    def _health_probes(self, timings=False, level=None, max_lag=None):
+        """Returns the master probes and the slave probes of one check as lists of
+        (key, probe) pairs, and a function building the check_health dictionary from a
+        dict of their results.
         """
+        check = _Check(timings, self._check_level(level), max_lag)
         master_connection = self._connection[self._database]
-        master = self._connection.host
+        master = self._master_host()
+        pool = self.probe_pool
+        slaves = [host for host in self._hosts if host != master]
+        if pool is not None:
+            pool.retain(self, [self._pool_key(slave) for slave in slaves])
+        if self.topology is not None:
+            change = self._track_topology(check, master, slaves)
+        master_probes = []
+        if check.level == FULL:
+            self._write_probe()
+            write = self._write_probe_task(lambda: self._can_write_to_master(master_connection, master, check), check)
+            master_probes.append(('db_master_can_write', self._metered(check, 'db_master_can_write', master, 'master_write', write)))
+            if max_lag is not None:
+                master_probes.append(('db_slaves_replication_lag_ms', self._replication_lag_probe(slaves, check)))
+        if check.level == PING:
+            read = lambda: self._can_ping_master(master_connection, master, check)
+        else:
+            read = lambda: self._can_read_from_master(master_connection, master, check)
+        master_probes.append(('db_master_can_read', self._metered(check, 'db_master_can_read', master, 'master_read', read)))
+        slave_probes = [(slave, self._guarded(slave, self._metered(check, slave, slave, 'slave_read', self._slave_probe(slave, master, check))))
+                        for slave in slaves]
+
+        def assemble(results):
+            slaves_can_read = [(slave, results.get(slave, False)) for slave in slaves]
+            health = {'db_master_host': master,
+                      'db_slave_hosts': slaves,
+                      'db_master_can_read':results.get('db_master_can_read'),
+                      'db_master_can_write':results.get('db_master_can_write'),
+                      'db_slaves_can_read':slaves_can_read,
+                      'db_master_url': master,
+                      'db_slave_url': None,
+                      'db_slave_can_read': False
+                      }
+            if slaves:
+                health['db_slave_url'], health['db_slave_can_read'] = slaves_can_read[0]
+            if max_lag is not None:
+                lags = results.get('db_slaves_replication_lag_ms')
+                if lags == SKIPPED:
+                    check.finish()
+                if not isinstance(lags, list):
+                    lags = [(slave, None) for slave in slaves]
+                health['db_slaves_replication_lag_ms'] = lags
+                health['db_slave_replication_lag_ms'] = None
+                if lags:
+                    health['db_slave_replication_lag_ms'] = lags[0][1]
+            if pool is not None:
+                health['db_probe_connects_saved'] = len(check.reused)
+            if check.meters:
+                self._count_timeouts(check, results)
+            if self.circuit_breaker is not None:
+                health['db_open_circuits'] = self.circuit_breaker.open_nodes()
+            if self.read_router is not None:
+                self.read_router.retain(slaves)
+                health['db_read_ranking'] = self.read_router.ranking()
+            if self.topology is not None:
+                self._record_topology(check, slaves_can_read)
+                health['db_topology_changes'] = change
+            return check.annotate(health)
+        return master_probes, slave_probes, assemble
+
+    def _master_host(self):
+        """Returns the host of the URI the connection has found to be master."""
+        host = self._connection.host
+        port = getattr(self._connection, 'port', None)
+        for candidate in self._hosts:
+            if candidate == host:
+                return candidate
+            if port is not None and _host_key(candidate) == '%s:%s' % (host, port):
+                return candidate
+        return host
+
+    def _slave_probe(self, slave, master, check):
+        def probe():
+            with check.timed(slave, 'total'):
+                return self._can_read_from_slave(slave, master, check)
+        return probe
+
+    def _can_write_to_master(self, master_connection, master, check=None):
+        check = check or _Check()
+        if self._write_probe() == FIND_AND_MODIFY_PROBE:
+            token = str(uuid.uuid1())
+            can_write = self._can_find_and_modify(master_connection['friskmonitoring'], master, token, check)
+            if can_write:
+                check.wrote(self._database, {'_id': self.probe_document_id, 'token': token})
+            return can_write
         id = str(uuid.uuid1())
         test_data = {"_id":id, 'date': datetime.datetime.now().microsecond}
-
+        if self.probe_ttl is not None:
+            test_data['created'] = _bson_now()
         db_master_can_write = False
         try:
-            master_connection['friskmonitoring'].save(test_data)
-            db_master_can_write = master_connection['friskmonitoring'].find_one({'_id':id}) == test_data
+            with check.timed(master, 'save'):
+                master_connection['friskmonitoring'].save(test_data)
+            with check.timed(master, 'find_one'):
+                db_master_can_write = _read_back(master_connection['friskmonitoring'].find_one({'_id':id}), test_data)
+            if db_master_can_write:
+                check.wrote(self._database, {'_id':id})
         except:
             pass
         finally:
-            master_connection['friskmonitoring'].remove({'_id':id})
+            if self.probe_ttl is None and check.written is None:
+                with check.timed(master, 'remove'):
+                    master_connection['friskmonitoring'].remove({'_id':id})
+            elif self.probe_ttl is None:
+                check.defer(lambda: master_connection['friskmonitoring'].remove({'_id':id}))
+        return db_master_can_write
+
+    def _probe_collection(self):
+        return self._connection[self._database]['friskmonitoring']
 
+    def _can_read_from_master(self, master_connection, master, check=None):
+        check = check or _Check()
         db_master_can_read = False
         try:
-            db_master_can_read = master_connection.collection_names() != []
+            with check.timed(master, 'collection_names'):
+                db_master_can_read = master_connection.collection_names() != []
         except:
             pass
+        return db_master_can_read
 
-        db_slave_can_read = False
-        hosts = copy.copy(self._hosts)
-        if len(hosts) > 1:
-            hosts.remove(master)
-            slave = hosts[0]
-            slave_connection = None
-            try:
-                slave_uri = copy.copy(self._uri)
-                if "," in slave_uri:
-                    slave_uri = slave_uri.replace(master, '').replace(',','')
-                    slave_uri = slave_uri.replace(master, '').replace(',','')
-                slave_connection = mongo_con.from_uri(slave_uri,slave_okay=True)
-                db_slave_can_read = slave_connection[self._database].collection_names() != []
-            except:
-                pass
-            finally:
-                if slave_connection:
-                    slave_connection.disconnect()
-        else:
-            slave = None
+    def _can_ping_master(self, master_connection, master, check=None):
+        check = check or _Check()
+        db_master_can_read = False
+        try:
+            with check.timed(master, 'ping'):
+                db_master_can_read = bool(master_connection.command('ping').get('ok'))
+        except:
+            pass
+        return db_master_can_read
 
-        return {'db_master_url': master,
-                'db_slave_url': slave,
-                'db_master_can_read':db_master_can_read,
-                'db_master_can_write':db_master_can_write,
-                'db_slave_can_read':db_slave_can_read
-                }
+    def _connect_to_slave(self, slave_uri):
+        return mongo_con.from_uri(slave_uri, slave_okay=True, network_timeout=self.slave_network_timeout)
+
+    def _connect_to_member(self, slave):
+        """Opens a routed read connection to slave with the URI's credentials and the
+        connection options given to this PyMongoFrisk, rather than the probe's.
+        """
+        return mongo_con.from_uri(self._slave_uri(slave), **dict(self._connection_options, slave_okay=True))
+
+    def _master_connection(self):
+        return self._connection
+
+    def _slave_uri(self, slave):
+        """Returns the URI of slave alone, with the credentials, database and options of
+        the URI but the replicaSet option, so that it is not redirected to the master.
+        """
+        slave_uri = self._scheme + "://"
+        if self._username is not None:
+            slave_uri += "%s:%s@" % (self._username, self._password)
+        slave_uri += slave
+        if self._database is not None:
+            slave_uri += "/" + self._database
+        options = [(name, value) for name, value in self._options if name.lower() != 'replicaset']
+        if options:
+            if self._database is None:
+                slave_uri += "/"
+            slave_uri += "?" + "&".join("%s=%s" % option for option in options)
+        return slave_uri
+
+    def _pool_key(self, slave):
+        """Keys slave's probe connection by its credentials, database and options as
+        well as its host, so that a shared pool never hands it to another URI.
+        """
+        return self._slave_uri(_host_key(slave))
+
+    def _open_slave(self, slave, check=None):
+        """Returns a connection to slave, with the credentials of the master URI, taken
+        from probe_pool when one is set.
+        """
+        check = check or _Check()
+        slave_uri = self._slave_uri(slave)
+        with check.timed(slave, 'connect'):
+            if self.probe_pool is None:
+                return self._connect_to_slave(slave_uri)
+            slave_connection, was_reused = self.probe_pool.get(self._pool_key(slave), lambda: self._connect_to_slave(slave_uri))
+        if was_reused:
+            check.reused.append(slave)
+        return slave_connection
+
+    def _release_slave(self, slave, slave_connection, failed=False):
+        if self.probe_pool is None:
+            slave_connection.disconnect()
+        elif failed:
+            self.probe_pool.discard(self._pool_key(slave))
+
+    def _can_read_from_slave(self, slave, master, check=None):
+        check = check or _Check()
+        db_slave_can_read = False
+        slave_connection = None
+        failed = False
+        try:
+            slave_connection = self._open_slave(slave, check)
+            if check.level_for(slave) == PING:
+                with check.timed(slave, 'ping'):
+                    db_slave_can_read = bool(slave_connection[self._database].command('ping').get('ok'))
+            else:
+                with check.timed(slave, 'collection_names'):
+                    db_slave_can_read = slave_connection[self._database].collection_names() != []
+                if db_slave_can_read and not self._diagnostics_denied:
+                    try:
+                        db_slave_can_read = self._diagnose(slave, slave_connection, check)
+                    except pymongo.errors.OperationFailure as e:
+                        # Users without clusterMonitor rights are refused every time.
+                        if _unauthorized(e):
+                            self._diagnostics_denied = True
+                    except Exception:
+                        pass
+        except:
+            failed = True
+        finally:
+            if slave_connection is not None:
+                self._release_slave(slave, slave_connection, failed)
+        return db_slave_can_read
 
     def _parse_uri(self, uri):
         try:
-            rest  = uri.split("://")[1]
+            self._scheme, rest = uri.split("://", 1)
             if "@" in rest:
-                auth, rest = rest.split("@")
-                self._username , self._password = auth.split(":")
+                auth, rest = rest.rsplit("@", 1)
+                self._username , self._password = auth.split(":", 1)
             else:
                 self._username , self._password = None, None
+            options = ""
+            if "?" in rest:
+                rest, options = rest.split("?", 1)
             if "/" in rest:
-                hosts, self._database = rest.split("/")
+                hosts, self._database = rest.split("/", 1)
+                self._database = self._database or None
             else:
                 self._database = None
                 hosts = rest
             self._hosts = hosts.split(",")
-            if len(self._hosts) > 2:
-                raise pymongo.errors.InvalidURI("Too many hosts")
+            for host in self._hosts:
+                if ":" in host:
+                    int(host.split(":")[1])
+                elif not host:
+                    raise ValueError(host)
+            self._options = []
+            for option in options.replace(";", "&").split("&"):
+                if option:
+                    name, value = option.split("=", 1)
+                    self._options.append((name, value))
         except:
             raise pymongo.errors.InvalidURI("Uri not in expected format")
 
+class FriskFleet(object):
+    """Checks the health of many replica sets at once. clusters maps a name to either
+    the seed list of a replica set, checked with FriskConnection, or a mongodb:// URI,
+    checked with PyMongoFrisk; connection_options are passed to each new connection.
+    At most max_concurrency clusters are checked at a time, and at most
+    max_concurrency node probes run at a time across all of them, through the
+    probe_slots semaphore every connection shares. They also share one
+    ProbeConnectionPool, so a host that belongs to several clusters is probed over a
+    single connection, unless their URIs differ in credentials or database. Probe
+    outcomes are recorded in metrics, a ProbeMetrics, if given. close() only closes a
+    probe_pool the fleet created itself.
+    """
+    def __init__(self, clusters, max_concurrency=8, timeout=None, probe_pool=None, metrics=None, **connection_options):
+        self.clusters = dict(clusters)
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self._owns_pool = probe_pool is None
+        if probe_pool is None:
+            probe_pool = ProbeConnectionPool()
+        self.probe_pool = probe_pool
+        self.metrics = metrics
+        self._connection_options = connection_options
+        self._connections = {}
+        self._lock = threading.Lock()
+        self.probe_slots = threading.BoundedSemaphore(max_concurrency)
+
+    def connection(self, name):
+        """Returns the Frisk connection of cluster name, connecting on first use."""
+        self._lock.acquire()
+        try:
+            connection = self._connections.get(name)
+        finally:
+            self._lock.release()
+        if connection is not None:
+            return connection
+        seeds = self.clusters[name]
+        if isinstance(seeds, _string_types):
+            connection = PyMongoFrisk(seeds, **self._connection_options)
+        else:
+            connection = FriskConnection(seeds, **self._connection_options)
+        connection.probe_pool = self.probe_pool
+        connection.probe_slots = self.probe_slots
+        connection.metrics = self.metrics
+        self._lock.acquire()
+        try:
+            existing = self._connections.setdefault(name, connection)
+        finally:
+            self._lock.release()
+        if existing is not connection:
+            connection.disconnect()
+        return existing
+
+    def iter_health(self, timeout=None, **options):
+        """Yields (name, health) for each cluster as soon as its check completes. options
+        are passed to every check_health() call. A cluster that cannot be connected to,
+        or has not answered once timeout seconds (by default the fleet's timeout) have
+        passed, is reported as {'db_error': message}.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        probes = [(name, self._cluster_probe(name, options)) for name in sorted(self.clusters)]
+        for name, health in _iter_probes(probes, timeout, self.max_concurrency):
+            if health == TIMED_OUT:
+                health = {'db_error': TIMED_OUT}
+            yield name, health
+
+    def check_health(self, timeout=None, **options):
+        """Returns a dictionary of cluster name -> health, as yielded by iter_health()."""
+        return dict(self.iter_health(timeout, **options))
+
+    def update(self, clusters):
+        """Replaces the clusters, disconnecting from those that were removed or whose
+        seeds changed and releasing their members from the probe pool.
+        """
+        clusters = dict(clusters)
+        self._lock.acquire()
+        try:
+            stale = [self._connections.pop(name) for name in list(self._connections)
+                     if clusters.get(name) != self.clusters.get(name)]
+            self.clusters = clusters
+        finally:
+            self._lock.release()
+        for connection in stale:
+            self._disconnect(connection)
+
+    def close(self):
+        self._lock.acquire()
+        try:
+            connections = list(self._connections.values())
+            self._connections.clear()
+        finally:
+            self._lock.release()
+        for connection in connections:
+            self._disconnect(connection)
+        if self._owns_pool:
+            self.probe_pool.close()
+
+    def _disconnect(self, connection):
+        self.probe_pool.release(connection)
+        connection.disconnect()
+
+    def _cluster_probe(self, name, options):
+        def probe():
+            try:
+                return self.connection(name).check_health(**options)
+            except Exception as e:
+                return {'db_error': str(e)}
+        return probe
+
+def _shard_seeds(host):
+    """Returns the seed list of a config.shards host, 'set/host1:port,host2:port' for
+    a replica set shard or 'host:port' for a single server.
+    """
+    return host.split('/', 1)[-1].split(',')
+
+class ShardedFrisk(object):
+    """Checks the health of a sharded cluster starting from a mongos, given as its host,
+    a list of hosts or a pymongo Connection. The shards are read from config.shards and
+    the config servers from the mongos' command line options; every shard's replica
+    set is then checked by a FriskFleet while the config servers are pinged, at most
+    max_concurrency at a time. The shard list is read on every check, but the config
+    servers are rediscovered and the fleet updated only when it changes. The other
+    arguments are as for FriskFleet.
+    """
+    slave_network_timeout = _HealthCheckMixin.slave_network_timeout
+
+    def __init__(self, mongos, max_concurrency=8, timeout=None, probe_pool=None, metrics=None, **connection_options):
+        self.mongos = mongos
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.fleet = FriskFleet({}, max_concurrency, timeout, probe_pool, metrics, **connection_options)
+        self.shards = None
+        self.config_servers = []
+        self._mongos = None
+        self._lock = threading.Lock()
+
+    def discover(self):
+        """Reads config.shards through the mongos and, when the shard list differs from
+        the one found last time, rediscovers the config servers and updates the fleet.
+        Returns True when the shard list changed.
+        """
+        self._lock.acquire()
+        try:
+            if self._mongos is None:
+                if isinstance(self.mongos, _string_types) or isinstance(self.mongos, (list, tuple)):
+                    self._mongos = pymongo.connection.Connection(
+                        self.mongos, network_timeout=self.slave_network_timeout)
+                else:
+                    self._mongos = self.mongos
+            shards = {}
+            for shard in self._mongos['config']['shards'].find():
+                shards[shard['_id']] = shard['host']
+            if shards == self.shards:
+                return False
+            parsed = self._mongos.admin.command('getCmdLineOpts').get('parsed', {})
+            self.config_servers = [_host_key(host, 27019) for host in parsed.get('configdb', '').split(',') if host]
+            self.fleet.probe_pool.retain(self, self.config_servers)
+            self.fleet.update(dict((name, _shard_seeds(host)) for name, host in shards.items()))
+            self.shards = shards
+            return True
+        finally:
+            self._lock.release()
+
+    def check_health(self, timeout=None, **options):
+        """Returns one report of the whole cluster: 'db_mongos_can_read', whether the
+        shard list could be read through the mongos; 'db_config_servers' as [(host,
+        answered a ping)]; 'db_shards' mapping each shard to the check_health() result
+        of its replica set, or {'db_error': message}; and 'db_shards_changed', True when
+        this check found a different shard list. options are passed to the check_health()
+        of every shard. When the mongos cannot be read the report is only
+        'db_mongos_can_read' False and 'db_error'. Discovery counts against timeout.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        started = time.time()
+        changed = _run_probes([('discover', self._discover_probe)], timeout, 1)['discover']
+        if changed == TIMED_OUT or isinstance(changed, Exception):
+            return {'db_mongos_can_read': False, 'db_error': str(changed)}
+        if timeout is not None:
+            timeout = max(0, timeout - (time.time() - started))
+        config_servers, shards = self.config_servers, sorted(self.shards)
+        probes = [(('config', host), self._config_probe(host)) for host in config_servers]
+        probes.extend((('shard', name), self.fleet._cluster_probe(name, options)) for name in shards)
+        results = dict(_iter_probes(probes, timeout, self.max_concurrency))
+        health = {'db_mongos_can_read': True,
+                  'db_shards_changed': changed,
+                  'db_config_servers': [(host, results[('config', host)]) for host in config_servers],
+                  'db_shards': {}}
+        for name in shards:
+            result = results[('shard', name)]
+            if result == TIMED_OUT:
+                result = {'db_error': TIMED_OUT}
+            health['db_shards'][name] = result
+        return health
+
+    def close(self):
+        self.fleet.probe_pool.release(self)
+        self.fleet.close()
+        if self._mongos is not None and self._mongos is not self.mongos:
+            self._mongos.disconnect()
+        self._mongos = None
+        self.shards = None
+
+    def _discover_probe(self):
+        try:
+            return self.discover()
+        except Exception as e:
+            return e
+
+    def _config_probe(self, host):
+        def probe():
+            pool, slots = self.fleet.probe_pool, self.fleet.probe_slots
+            slots.acquire()
+            try:
+                connection, was_reused = pool.get(host, lambda: pymongo.connection.Connection(
+                    host, network_timeout=self.slave_network_timeout, slave_okay=True))
+                try:
+                    return bool(connection.admin.command('ping').get('ok'))
+                except Exception:
+                    pool.discard(host)
+                    return False
+            finally:
+                slots.release()
+        return probe
+
+def health_status(health):
+    """Sums up a check_health() result: 'connecting' while a lazy PyMongoFrisk is still
+    connecting, 'down' when the master cannot be read or written (or the check
+    failed), 'degraded' when a slave cannot be read or a node is overloaded, else 'ok'.
+    A ShardedFrisk report is 'down' when a shard is, and 'degraded' when a shard is or
+    a config server does not answer.
+    """
+    if health.get('db_state') == CONNECTING:
+        return CONNECTING
+    if 'db_error' in health:
+        return DOWN
+    if 'db_shards' in health:
+        statuses = [health_status(shard) for shard in health['db_shards'].values()]
+        if DOWN in statuses:
+            return DOWN
+        for host, can_ping in health['db_config_servers']:
+            if can_ping is not True:
+                return DEGRADED
+        if DEGRADED in statuses:
+            return DEGRADED
+        return OK
+    if health.get('db_master_can_read') is not True or health.get('db_master_can_write') not in (True, None):
+        return DOWN
+    if 'db_slaves_can_read' in health:
+        slaves = [can_read for slave, can_read in health['db_slaves_can_read']]
+    elif health.get('db_slave_url') is not None:
+        slaves = [health.get('db_slave_can_read')]
+    else:
+        slaves = []
+    for can_read in slaves:
+        if can_read is not True:
+            return DEGRADED
+    for signals in health.get('db_load', {}).values():
+        if signals.get('overloaded'):
+            return DEGRADED
+    return OK
+
+class _ThreadingWSGIServer(socketserver.ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+class _QuietWSGIRequestHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+class HealthEndpoint(object):
+    """WSGI application serving the health of a FriskConnection or PyMongoFrisk as JSON.
+    Requests never probe: they are answered from the frisk's health cache, which is
+    enabled here with check_health options if it is not already, and is refreshed by
+    its own background thread every refresh_interval seconds. Each snapshot is
+    serialized once, however many times it is served.
+
+    The status code is 200 while health_status() is 'ok', degraded_status (200 by
+    default) while it is 'degraded', and 503 when it is 'down' or 'connecting', before
+    the first check has finished, or once the snapshot is older than the cache's ttl
+    ('stale'). 'db_status' in the body holds the status and the Age header the age of
+    the snapshot in seconds.
+    """
+    statuses = {200: '200 OK', 207: '207 Multi-Status', 503: '503 Service Unavailable'}
+
+    def __init__(self, frisk, refresh_interval=1, ttl=5, degraded_status=200, **options):
+        if frisk.health_cache is None:
+            frisk.enable_health_cache(ttl, refresh_interval, **options)
+        elif not frisk.health_cache.refresh_interval:
+            raise ValueError("HealthEndpoint needs a health cache refreshed in the background")
+        self.frisk = frisk
+        self.degraded_status = degraded_status
+        self._rendered = None
+        self._starting = self._render_body(503, {'db_status': STARTING})
+
+    def __call__(self, environ, start_response):
+        method = environ.get('REQUEST_METHOD', 'GET')
+        if method not in ('GET', 'HEAD'):
+            start_response('405 Method Not Allowed', [('Allow', 'GET, HEAD'), ('Content-Length', '0')])
+            return [b'']
+        status, body, taken = self.response()
+        headers = [('Content-Type', 'application/json'),
+                   ('Content-Length', str(len(body))),
+                   ('Cache-Control', 'no-cache')]
+        if taken is not None:
+            headers.append(('Age', str(int(max(0, time.time() - taken)))))
+        start_response(status, headers)
+        if method == 'HEAD':
+            return [b'']
+        return [body]
+
+    def response(self):
+        """Returns (status line, JSON body, time the snapshot was taken or None)."""
+        snapshot = self.frisk.health_cache.peek()
+        if snapshot is None:
+            return self._starting + (None,)
+        if time.time() - snapshot[1] > self.frisk.health_cache.ttl:
+            return self._render_body(503, dict(snapshot[0], db_status=STALE)) + (snapshot[1],)
+        rendered = self._rendered
+        if rendered is None or rendered[0] is not snapshot:
+            rendered = self._rendered = (snapshot, self.render(snapshot[0]))
+        return rendered[1] + (snapshot[1],)
+
+    def render(self, health):
+        """Returns the (status line, JSON body) served for a check_health() result."""
+        status = health_status(health)
+        code = 200
+        if status == DEGRADED:
+            code = self.degraded_status
+        elif status != OK:
+            code = 503
+        health = dict(health)
+        health['db_status'] = status
+        return self._render_body(code, health)
+
+    def _render_body(self, code, health):
+        status = self.statuses.get(code, '%d Health Status' % code)
+        return status, json.dumps(health, sort_keys=True, default=str).encode('utf-8')
+
+    def make_server(self, host='', port=8080):
+        """Returns a threaded wsgiref server answering on host:port with this endpoint."""
+        return _make_server(self, host, port)
+
+    def start(self, host='', port=8080):
+        """Serves this endpoint on host:port from a daemon thread and returns the server;
+        call its shutdown() to stop.
+        """
+        return _start_server(self.make_server(host, port))
+
+def _make_server(app, host, port):
+    server = _ThreadingWSGIServer((host, port), _QuietWSGIRequestHandler)
+    server.set_app(app)
+    return server
+
+def _start_server(server):
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+def _probe_outcome(result):
+    if result is True:
+        return 'ok'
+    if result == WRITE_LOCKED:
+        return 'write_locked'
+    return 'failed'
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class ProbeMetrics(object):
+    """Counts probe outcomes ('ok', 'failed', 'write_locked' and 'timed_out') and keeps
+    a latency histogram per node and probe ('master_write', 'master_read' or
+    'slave_read') for every check of the connections whose metrics it is set as.
+    render() writes them in the Prometheus text exposition format, and the object is
+    itself a WSGI application serving them; neither ever probes. Recording only
+    holds a lock while updating counters in memory.
+    """
+    buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, buckets=None):
+        if buckets is not None:
+            self.buckets = tuple(sorted(buckets))
+        self._outcomes = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def observe(self, node, probe, result, seconds):
+        """Records a finished probe: its check_health() result and how long it took."""
+        outcome = (node, probe, _probe_outcome(result))
+        bucket = bisect.bisect_left(self.buckets, seconds)
+        self._lock.acquire()
+        try:
+            self._outcomes[outcome] = self._outcomes.get(outcome, 0) + 1
+            histogram = self._histograms.get((node, probe))
+            if histogram is None:
+                histogram = self._histograms[(node, probe)] = [0] * (len(self.buckets) + 1) + [0.0]
+            histogram[bucket] += 1
+            histogram[-1] += seconds
+        finally:
+            self._lock.release()
+
+    def timed_out(self, node, probe):
+        """Records a probe reported as "Timed Out" by its check."""
+        outcome = (node, probe, 'timed_out')
+        self._lock.acquire()
+        try:
+            self._outcomes[outcome] = self._outcomes.get(outcome, 0) + 1
+        finally:
+            self._lock.release()
+
+    def render(self):
+        self._lock.acquire()
+        try:
+            outcomes = sorted(self._outcomes.items())
+            histograms = sorted((key, list(histogram)) for key, histogram in self._histograms.items())
+        finally:
+            self._lock.release()
+        lines = ['# HELP frisk_probes_total Health probes by node, probe and outcome.',
+                 '# TYPE frisk_probes_total counter']
+        for (node, probe, outcome), count in outcomes:
+            lines.append('frisk_probes_total{node="%s",probe="%s",outcome="%s"} %d'
+                         % (_label(node), _label(probe), outcome, count))
+        lines.append('# HELP frisk_probe_duration_seconds Latency of finished health probes.')
+        lines.append('# TYPE frisk_probe_duration_seconds histogram')
+        for (node, probe), histogram in histograms:
+            labels = 'node="%s",probe="%s"' % (_label(node), _label(probe))
+            count = 0
+            for bound, observed in zip(self.buckets + ('+Inf',), histogram[:-1]):
+                count += observed
+                lines.append('frisk_probe_duration_seconds_bucket{%s,le="%s"} %d' % (labels, bound, count))
+            lines.append('frisk_probe_duration_seconds_sum{%s} %r' % (labels, histogram[-1]))
+            lines.append('frisk_probe_duration_seconds_count{%s} %d' % (labels, count))
+        return '\n'.join(lines) + '\n'
+
+    def __call__(self, environ, start_response):
+        body = self.render().encode('utf-8')
+        start_response('200 OK', [('Content-Type', 'text/plain; version=0.0.4'),
+                                  ('Content-Length', str(len(body)))])
+        return [body]
+
+    def make_server(self, host='', port=9108):
+        return _make_server(self, host, port)
+
+    def start(self, host='', port=9108):
+        """Serves the metrics on host:port from a daemon thread and returns the server."""
+        return _start_server(self.make_server(host, port))
+
 Connection = PyMongoFrisk